@@ -1,14 +1,16 @@
+import time
+# Reported as the time to serving once the app is initialized
+START_TIME = time.time()
 import os
 import logging
-from logging.handlers import TimedRotatingFileHandler
 import json
 import re
 from flask import (
-        Flask, jsonify,
-        render_template, request, redirect, url_for, session, abort
+        Flask, jsonify, Response, stream_with_context,
+        render_template, request, redirect, url_for, session, abort, g
         )
-import time
 import sys
+import threading
 #from textwrap import dedent
 import datetime
 from flask_jwt_extended import JWTManager
@@ -16,8 +18,17 @@ from flask_jwt_extended import (
             create_access_token, decode_token
 )
 
-from security import authenticate, identity, find_container_ip_addr
-from database_access_object import Teams
+from security import authenticate, identity, AllowedHosts, TTLCache, IDENTITIES, IDENTITY_CACHE_SIZE
+from database_access_object import Teams, release_connection, wait_for_database, ping, POOL_STATS, HISTORY_COLUMNS
+from migrations import migrate, to_datetime
+from job_queue import JobQueue
+from eta import RuntimeEstimator
+from scoreboard import Snapshot, SnapshotCache, to_json
+from events import EventBroker, format_sse
+from shared_state import create_state_store
+from ranking_engine import RankingEngine, create_ranking_engine, RANKING_STRATEGY
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from logging_setup import configure_logging
 
 # --- APP ---
 app = Flask(__name__)
@@ -27,25 +38,30 @@ if app.config['SECRET_KEY'] == 'UNDEFINED':
     raise ValueError('Please define SECRET_KEY!')
 
 JWTManager(app) # Needed to create and validate JWT tokens 
+app.config['PERMANENT_SESSION_LIFETIME'] = datetime.timedelta(
+        seconds=int(os.getenv("FLASK_SESSION_TIMEOUT_SECONDS", default=60)))
 
 # Init logging
 LOG_FOLDER_NAME = "frontend_logs"
 LOG_FILENAME = 'controller.log'
-os.makedirs(LOG_FOLDER_NAME, exist_ok=True)
+configure_logging(LOG_FOLDER_NAME, LOG_FILENAME)
 logger = logging.getLogger()
-logging.basicConfig(
-                    level=logging.DEBUG,
-                    format='%(asctime)s - %(name)s - %(threadName)s -  %(levelname)s - %(message)s',
-                    handlers=[
-                     TimedRotatingFileHandler("%s/%s" % (LOG_FOLDER_NAME, LOG_FILENAME), when="midnight", interval=1), 
-                     logging.StreamHandler()
-                    ])
 
 # Init state
 MIN_WAIT_TIME_SECONDS = 60
-DELTA = datetime.timedelta(minutes=10) # average waiting time initial
-CYCLE_TIME = datetime.timedelta(minutes=10)
-UPDATE_TIME = datetime.datetime.utcnow()
+DEFAULT_DELTA_SECONDS = 10 * 60 # average waiting time initial
+STATE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# State shared by all worker processes (see shared_state.py):
+#   delta_seconds - longest benchmark runtime, the expected runtime while no benchmark ran
+#   team_status - dictionary of image -> status
+#     describing the status of each image in the system
+#     image = string in the form "username/image_name" at DockerHub
+#   status_version - incremented whenever team_status changes
+#   ranking_version - incremented whenever the teams table changes (see Teams)
+#   registrations_version - incremented whenever a user is added (see create_access.py)
+#   jobs_version - incremented whenever the job queue changes (see JobQueue)
+STATE = create_state_store()
 
 # The columns containing the actual user score
 SCORE_COLUMNS = ['total_runtime', 'latency', 'accuracy', 'timeliness']
@@ -53,47 +69,112 @@ SCORE_COLUMNS = ['total_runtime', 'latency', 'accuracy', 'timeliness']
 USER_EXCLUDE_COLUMNS = ['image'] + SCORE_COLUMNS
 # Time columns which need to be formatted for presentation
 FORMAT_TIME_COLUMNS = ['last_run', 'time_tag']
+# Boolean columns, stored as TINYINT by MySQL
+BOOLEAN_COLUMNS = ['updated']
 MANAGER_URI = os.getenv("REMOTE_MANAGER_SERVER")
-SCHEDULER_URI = find_container_ip_addr(os.getenv("SCHEDULER_IP"))
-ALLOWED_HOSTS = [MANAGER_URI, SCHEDULER_URI]
+# Host name (e.g. the scheduler container name) or IP address
+SCHEDULER_URI = os.getenv("SCHEDULER_IP")
+ALLOWED_HOSTS = AllowedHosts([MANAGER_URI, SCHEDULER_URI])
 SANITY_CHECK_FIELD = SCORE_COLUMNS[0]
 logging.debug("Allowed hosts are: %s", ALLOWED_HOSTS)
 
 # The table storing the info for each team, including image, latest scores, etc
-TEAMS_DAO = Teams('teams')
-
-# Dictionary of image -> status
-# Describing the status of each image in the system
-# image = string in the form "username/image_name" at DockerHub
-TEAM_STATUS = {} 
+TEAMS_DAO = Teams('teams', state=STATE, engine=create_ranking_engine())
+DB_WAIT_SECONDS = wait_for_database(TEAMS_DAO.database.engine)
+logging.info("Database schema is at version %d", migrate(TEAMS_DAO.database.engine))
+
+# Images waiting to be benchmarked, leased to the managers through /jobs
+JOBS = JobQueue(TEAMS_DAO.database, state=STATE)
+# Runtime of every image, learned from the results history to predict the queue ETAs
+RUNTIMES = RuntimeEstimator()
+# (ranking rows, image -> team name) of the last ranking the queue was labelled from
+TEAM_NAMES = (None, {})
+
+# Pre-rendered public scoreboard (HTML and JSON)
+SCOREBOARD = SnapshotCache()
+
+# Scoreboard deltas pushed to watchers of /events
+EVENTS = EventBroker()
+EVENT_KEEPALIVE_SECONDS = int(os.getenv("EVENT_KEEPALIVE_SECONDS", default=15))
+EVENT_POLL_TIMEOUT_SECONDS = int(os.getenv("EVENT_POLL_TIMEOUT_SECONDS", default=25))
+# How often a worker checks the shared state for changes made by other workers
+EVENT_SYNC_SECONDS = float(os.getenv("EVENT_SYNC_SECONDS", default=1))
+EVENT_SYNC_THREAD = None
+EVENT_SYNC_LOCK = threading.Lock()
+
+# access token -> decoded payload, so that the token of a session is verified once
+TOKENS = TTLCache(IDENTITY_CACHE_SIZE, app.config['PERMANENT_SESSION_LIFETIME'].total_seconds())
+
+# Metrics exposed on /metrics
+REQUEST_SECONDS = REGISTRY.histogram('controller_request_seconds', 'Request latency per route', ['method', 'route'])
+REQUESTS = REGISTRY.counter('controller_requests_total', 'Requests per route and status', ['method', 'route', 'status'])
+REQUESTS_IN_FLIGHT = REGISTRY.gauge('controller_requests_in_flight', 'Requests being handled')
+TEMPLATE_RENDER_SECONDS = REGISTRY.histogram('controller_template_render_seconds', 'Template render time', ['template'])
+RESULTS_RECEIVED = REGISTRY.counter('controller_results_received_total', 'Benchmark results posted to /result', ['outcome'])
+IMAGES_UPDATED = REGISTRY.counter('controller_images_updated_total', 'Image updates posted by the scheduler')
+STATUS_UPDATES = REGISTRY.counter('controller_status_updates_total', 'Team status updates posted by the scheduler')
+CACHE_STATS = REGISTRY.gauge('controller_cache_stat', 'Cache and connection pool counters, sampled on scrape', ['cache', 'stat'])
+
+# Page sizes of the per-team results history
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", default=100))
+HISTORY_MAX_PAGE_SIZE = 1000
+
+
+def generate_ranking_table(result, time_to_wait, skip_columns=[]):
+    ranking = {}
+    for rowIdx, row in enumerate(result or []):
+        ranking[rowIdx+1] = get_ranking_fields(row, skip_columns=skip_columns)
+    return ranking, generate_queue(result, time_to_wait)
 
 
-def generate_ranking_table(result, last_run, time_to_wait, skip_columns=[]):
-    ranking = {}
+def generate_queue(result, time_to_wait):
+    '''Return the queue entries [{name: {eta, status}}] of the running and queued teams.
+    Served from memory, with the ETAs anchored to the stored lease, queue and result times
+    '''
     queue = []
-    time = 0
-    update_waiting_time(time_to_wait)
+    # Single read of the shared state for the whole table
+    state = STATE.get_many(['delta_seconds', 'team_status'])
+    delta = update_waiting_time(time_to_wait, state['delta_seconds'])
+    team_status = state['team_status'] or {}
     if not result:
-        return ranking, queue
-    if last_run:
-        last_run = datetime.datetime.strptime(last_run, '%Y-%m-%dT%H:%M:%S')
-        last_run = max(last_run, UPDATE_TIME)
-        print("Max date is %s" % last_run)
-        time = last_run + DELTA + CYCLE_TIME
-    else:
-        time = UPDATE_TIME + DELTA + CYCLE_TIME
-    marked_to_run = 0
-    for rowIdx, row in enumerate(result):
-        ranking[rowIdx+1] = get_ranking_fields(row, skip_columns=[])
-        image = row.get('image', None)
-        current_status = TEAM_STATUS.get(image, "") if image else ""
-        if row.get('updated', None)  == "True" and time:
-            queue.append({row['name']: {
-                "eta": unconvert_time(time + DELTA*(marked_to_run)),
-                "status": current_status
+        return queue
+    names = team_names(result)
+    for image, eta in forecast_queue(delta):
+        if image in names:
+            queue.append({names[image]: {
+                "eta": unconvert_time(eta),
+                "status": team_status.get(image, "")
             }})
-            marked_to_run += 1
-    return ranking, queue
+    return queue
+
+
+def team_names(result):
+    '''image -> team name of the ranking rows, computed once per ranking'''
+    global TEAM_NAMES
+    rows, names = TEAM_NAMES
+    if rows is not result:
+        names = {row['image']: row['name'] for row in result if row.get('image')}
+        TEAM_NAMES = (result, names)
+    return names
+
+
+def current_jobs():
+    '''The running and queued jobs, from memory. When another worker changed the queue,
+    the results it received meanwhile are applied to the runtime estimates as well
+    '''
+    jobs, loaded = JOBS.snapshot()
+    if loaded:
+        catch_up_runtimes()
+    return jobs
+
+
+def catch_up_runtimes():
+    RUNTIMES.catch_up(TEAMS_DAO.iter_history(after=RUNTIMES.last_id))
+
+
+def forecast_queue(default_seconds):
+    '''Return [(image, eta)] of the running and queued images, in queue order'''
+    return RUNTIMES.forecast(current_jobs(), default_seconds)
 
 
 def get_ranking_fields(row, skip_columns=[]):
@@ -104,17 +185,141 @@ def get_ranking_fields(row, skip_columns=[]):
         if column in skip_columns:
             continue
         elif column in FORMAT_TIME_COLUMNS:
-            new_row[column] = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S') if value else '-'
+            # DATETIME columns, no parsing needed
+            new_row[column] = value if value else '-'
+        elif column in BOOLEAN_COLUMNS:
+            new_row[column] = bool(value)
         elif value != None:
             # Ignore None values to make formatting easier in the HTML template
             new_row[column] = value
     return new_row
 
 
-def update_waiting_time(seconds):
-    global DELTA
+def build_public_scoreboard(ranking_data, fmt):
+    '''Render the public scoreboard into a Snapshot, as HTML or JSON'''
+    query, _, waiting_time = ranking_data
+    queue = generate_queue(query, waiting_time)
+    ranking = {rowIdx+1: get_ranking_fields(row, skip_columns=USER_EXCLUDE_COLUMNS) for rowIdx, row in enumerate(query or [])}
+    if fmt == 'json':
+        return Snapshot(to_json({'ranking': list(ranking.values()), 'queue': queue}), 'application/json')
+    return Snapshot(render('table.html', ranking=ranking, queue=queue), 'text/html')
+
+
+def public_scoreboard(fmt):
+    expire_leases()
+    ranking_data = TEAMS_DAO.get_ranking()
+    # The queue and its ETAs only change with the job queue, the team status and the results (ranking)
+    version = STATE.get_many(['jobs_version', 'status_version', 'delta_seconds'])
+    snapshot = SCOREBOARD.get(fmt, ranking_data, version, lambda: build_public_scoreboard(ranking_data, fmt))
+    return snapshot.to_response(request)
+
+
+def publish_scoreboard():
+    '''Push the changed public ranking rows and queue entries to all watchers'''
+    query, _, waiting_time = TEAMS_DAO.get_ranking()
+    ranking, queue = generate_ranking_table(query, waiting_time, USER_EXCLUDE_COLUMNS)
+    EVENTS.publish_scoreboard(ranking, queue)
+
+
+def sync_events():
+    '''Publish the changes made through other worker processes to the watchers of this one,
+    and the jobs of managers whose lease expired meanwhile
+    '''
+    versions = None
+    while True:
+        expire_leases()
+        current_versions = STATE.get_many(['ranking_version', 'status_version', 'jobs_version'])
+        if current_versions != versions:
+            versions = current_versions
+            publish_scoreboard()
+            release_connection(TEAMS_DAO.database)
+        time.sleep(EVENT_SYNC_SECONDS)
+
+
+def ensure_event_sync():
+    global EVENT_SYNC_THREAD
+    with EVENT_SYNC_LOCK:
+        if EVENT_SYNC_THREAD is None:
+            EVENT_SYNC_THREAD = threading.Thread(target=sync_events, name='event-sync', daemon=True)
+            EVENT_SYNC_THREAD.start()
+    if EVENTS.last_id == 0:
+        publish_scoreboard()
+
+
+def expire_leases():
+    '''Queue the jobs of lost managers again and clear their running status'''
+    images = JOBS.requeue_expired()
+    if images:
+        set_team_status({image: '' for image in images})
+        publish_scoreboard()
+
+
+def update_waiting_time(seconds, current_seconds):
+    '''Return the average waiting time, storing the given one if it is valid and changed'''
     if seconds and seconds >= MIN_WAIT_TIME_SECONDS:
-        DELTA = datetime.timedelta(minutes=seconds/60)
+        if seconds != current_seconds:
+            STATE.set('delta_seconds', seconds)
+        return seconds
+    return current_seconds or DEFAULT_DELTA_SECONDS
+
+
+def set_team_status(statuses):
+    '''Atomically merge the image -> status dictionary into the shared team status'''
+    def merge(team_status):
+        team_status.update(statuses)
+        return team_status
+    STATE.update('team_status', merge, {})
+    STATE.incr('status_version')
+
+
+def render(template, **context):
+    '''render_template, timed per template'''
+    with TEMPLATE_RENDER_SECONDS.time(template=template):
+        return render_template(template, **context)
+
+
+def sample_cache_stats():
+    stats = {'ranking': TEAMS_DAO.ranking_cache_stats(), 'identity': IDENTITIES.stats(),
+             'token': TOKENS.stats(), 'db_pool': POOL_STATS.summary(TEAMS_DAO.database),
+             'scoreboard_snapshot': {'builds': SCOREBOARD.builds}}
+    for cache, values in stats.items():
+        for stat, value in values.items():
+            if isinstance(value, (int, float)):
+                CACHE_STATS.set(value, cache=cache, stat=stat)
+
+
+def history_cursor(row):
+    '''Opaque position of a results history row, to request the page after it'''
+    return '%s_%d' % (row['last_run'].strftime(STATE_TIME_FORMAT), row['id'])
+
+
+def parse_history_cursor(cursor):
+    '''Return the (last_run, id) of a cursor, None if it is invalid'''
+    last_run, _, result_id = cursor.rpartition('_')
+    if not result_id.isdigit() or not last_run:
+        return None
+    last_run = to_datetime(last_run)
+    return (last_run, int(result_id)) if last_run else None
+
+
+def stream_history_page(rows, limit):
+    '''Serialize a page of results history row by row, followed by the cursor of the next page'''
+    yield '{"results": ['
+    last_row = None
+    count = 0
+    for row in rows:
+        yield (', ' if count else '') + to_json({column: row[column] for column in HISTORY_COLUMNS})
+        last_row = row
+        count += 1
+    next_cursor = history_cursor(last_row) if count == limit else None
+    yield '], "next": %s}' % json.dumps(next_cursor)
+
+
+def stream_history_export(rows):
+    yield '['
+    for count, row in enumerate(rows):
+        yield (',\n' if count else '\n') + to_json(dict(row))
+    yield '\n]\n'
 
 
 def round_time(tm):
@@ -131,30 +336,40 @@ def check_auth(session):
     if not access_token:
         return False
     try:
-        payload = decode_token(access_token)
-        if not identity(payload):
-            return False
+        payload = TOKENS.get(access_token, lambda: decode_token(access_token))
     except:
         logging.warn("Invalid access token from IP: %s", request.remote_addr)
         return False
-    return True
+    if payload.get('exp') and payload['exp'] < time.time():
+        TOKENS.invalidate(access_token)
+        return False
+    # Served from the identity cache, the DB is only queried on a miss
+    return bool(identity(payload, STATE.get('registrations_version', 0)))
 
 
 # --- ROUTES ----
 @app.route('/result', methods=['POST'])
 def post_result():
-    global CYCLE_TIME
     if (request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4 ):
         jsonData = request.json
-        team = jsonData.get('image')
-        TEAM_STATUS[team] = '' # Clear team status
-        logging.info("Received result: %s", jsonData)
-        if not jsonData.get(SANITY_CHECK_FIELD, None):
+        # A single result or a list of results
+        results = jsonData if isinstance(jsonData, list) else [jsonData]
+        if not results or not all(isinstance(result, dict) for result in results):
+            RESULTS_RECEIVED.inc(outcome='rejected')
+            return jsonify({"message":"Bad request"}), 400
+        set_team_status({result.get('image'): '' for result in results}) # Clear team status
+        logging.info("Received %d results", len(results))
+        logging.debug("Received results: %s", jsonData)
+        if not all(result.get(SANITY_CHECK_FIELD, None) for result in results):
+            RESULTS_RECEIVED.inc(len(results), outcome='rejected')
             return jsonify({"message":"Bad request"}), 400
-        loop_time = jsonData.get('piggybacked_manager_timeout', CYCLE_TIME)
-        CYCLE_TIME = datetime.timedelta(seconds=loop_time)
         # update database
-        TEAMS_DAO.update_result(jsonData)
+        TEAMS_DAO.update_results(results)
+        # Results of runs the manager did not lease through /jobs
+        JOBS.settle(result['image'] for result in results)
+        catch_up_runtimes()
+        RESULTS_RECEIVED.inc(len(results), outcome='accepted')
+        publish_scoreboard()
         return json.dumps(jsonData), 200
     else:
         logging.warning("Host '%s' is NOT allowed to post results", request.remote_addr)
@@ -164,22 +379,70 @@ def post_result():
 @app.route('/', methods=['GET'])
 def index():
     '''User facing score table'''
-    logging.debug("/ route requested by IP address: %s " % request.remote_addr)
-    query, last_experiment_time, waiting_time = TEAMS_DAO.get_ranking()
-    ranking, queue = generate_ranking_table(query, last_experiment_time, waiting_time, USER_EXCLUDE_COLUMNS)
-    return render_template('table.html', ranking=ranking, queue=queue)
+    logging.debug("/ route requested by IP address: %s", request.remote_addr)
+    return public_scoreboard('html')
+
+
+@app.route('/scoreboard.json', methods=['GET'])
+def scoreboard_json():
+    '''User facing score table as JSON'''
+    logging.debug("/scoreboard.json route requested by IP address: %s", request.remote_addr)
+    return public_scoreboard('json')
+
+
+@app.route('/events', methods=['GET'])
+def events():
+    '''Server-sent events stream: a full snapshot, followed by ranking and queue deltas'''
+    ensure_event_sync()
+    last_id = request.headers.get('Last-Event-ID', type=int)
+
+    def stream(last_id):
+        if last_id is None:
+            last_id, state = EVENTS.snapshot()
+            yield format_sse(last_id, 'snapshot', state)
+        while True:
+            new_events = EVENTS.wait(last_id, EVENT_KEEPALIVE_SECONDS)
+            if new_events is None:
+                # Missed some deltas, start over from the current state
+                last_id, state = EVENTS.snapshot()
+                yield format_sse(last_id, 'snapshot', state)
+            elif not new_events:
+                yield ': keepalive\n\n'
+            for event in new_events or []:
+                last_id = event[0]
+                yield format_sse(*event)
+
+    return Response(stream(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/events/poll', methods=['GET'])
+def poll_events():
+    '''Long-poll fallback of /events. Returns the events after `since`, or a snapshot'''
+    ensure_event_sync()
+    since = request.args.get('since', type=int)
+    new_events = EVENTS.wait(since, EVENT_POLL_TIMEOUT_SECONDS) if since is not None else None
+    if new_events is None:
+        last_id, state = EVENTS.snapshot()
+        body = '{"last_id": %d, "snapshot": %s}' % (last_id, state)
+    else:
+        last_id = new_events[-1][0] if new_events else since
+        body = '{"last_id": %d, "events": [%s]}' % (last_id, ', '.join(
+            '{"id": %d, "event": "%s", "data": %s}' % event for event in new_events))
+    return Response(body, mimetype='application/json', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/scores', methods=['GET'])
 def scores():
     '''Admin score table with extra attributes'''
-    logging.debug("/scores route requested by IP address: %s " % request.remote_addr)
+    logging.debug("/scores route requested by IP address: %s", request.remote_addr)
     if not check_auth(session):
         return redirect(url_for('login', next=request.url))
     
-    query, last_experiment_time, waiting_time = TEAMS_DAO.get_ranking()
-    ranking, queue = generate_ranking_table(query, last_experiment_time, waiting_time)
-    return render_template('table_admin.html', ranking=ranking, queue=queue)
+    expire_leases()
+    query, _, waiting_time = TEAMS_DAO.get_ranking()
+    ranking, queue = generate_ranking_table(query, waiting_time)
+    return render('table_admin.html', ranking=ranking, queue=queue)
 
 
 @app.route('/score/<image_namespace>/<image_name>', methods=['GET'])
@@ -191,35 +454,133 @@ def team_score(image_namespace, image_name):
     return jsonify(teamScore)
 
 
+@app.route('/history/<image_namespace>/<image_name>', methods=['GET'])
+def team_history(image_namespace, image_name):
+    '''Score history of a single team, oldest run first.
+    Paginated with `limit` and the `next` cursor returned with the previous page
+    '''
+    image = image_namespace + '/' + image_name
+    logging.debug("/history/%s route requested by IP address: %s ", image, request.remote_addr)
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    after = None
+    if request.args.get('cursor'):
+        after = parse_history_cursor(request.args['cursor'])
+        if after is None:
+            return jsonify({"message": "Bad cursor"}), 400
+    rows = TEAMS_DAO.get_history(image, limit, after)
+    return Response(stream_with_context(stream_history_page(rows, limit)), mimetype='application/json')
+
+
+@app.route('/history', methods=['GET'])
+def history_export():
+    '''Export of all results ever received, streamed page by page'''
+    if not ((request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4) or check_auth(session)):
+        logging.warning(" %s is NOT allowed to export the history" % request.remote_addr)
+        return abort(403)
+    return Response(stream_with_context(stream_history_export(TEAMS_DAO.iter_history())), mimetype='application/json')
+
+
+@app.route('/ranking', methods=['GET'])
+def ranking_at():
+    '''Public ranking as it stood at the time given by `at`, e.g. ?at=2020-05-01T12:00:00'''
+    at = to_datetime(request.args.get('at'))
+    if at is None:
+        return jsonify({"message": "Missing or invalid 'at' time"}), 400
+    query, _, _ = TEAMS_DAO.get_ranking_at(at)
+    ranking = [get_ranking_fields(row, skip_columns=USER_EXCLUDE_COLUMNS) for row in query]
+    return Response(to_json({'at': at, 'ranking': ranking}), mimetype='application/json')
+
+
+@app.route('/ranking/whatif', methods=['GET'])
+def ranking_what_if():
+    '''Admin: the current ranking, or the one at `at`, re-scored with the given
+    `strategy` and `weights` ("column=weight,..."), without changing the scoreboard
+    '''
+    if not check_auth(session):
+        return redirect(url_for('login', next=request.url))
+    try:
+        engine = RankingEngine(request.args.get('strategy', RANKING_STRATEGY), request.args.get('weights', ''))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    at = None
+    if request.args.get('at'):
+        at = to_datetime(request.args['at'])
+        if at is None:
+            return jsonify({"message": "Invalid 'at' time"}), 400
+    start = time.time()
+    ranking = engine.rank(TEAMS_DAO.get_ranking_rows(at))
+    logging.info("Re-ranked %d teams with strategy %s in %.1f ms", len(ranking), engine.strategy, (time.time() - start) * 1000)
+    return Response(to_json({'strategy': engine.strategy, 'weights': dict(zip(engine.columns, engine.weights.tolist())), 'ranking': ranking}),
+                    mimetype='application/json')
+
+
 @app.route('/status_update', methods=['GET', 'POST'])
 def status():
     '''Status update endpoint for scheduler'''
     if (request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4):
         if request.method == 'GET':
-            return jsonify(TEAM_STATUS), 200
+            return jsonify(STATE.get('team_status', {})), 200
         if request.method == 'POST':
-            for team, status in request.json.items():
-                TEAM_STATUS[team] = status
-            return jsonify(TEAM_STATUS), 200
+            set_team_status(request.json)
+            STATUS_UPDATES.inc()
+            publish_scoreboard()
+            return jsonify(STATE.get('team_status', {})), 200
     else:
         logging.warning(" %s is NOT allowed to post schedule" % request.remote_addr)
         return abort(403)
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    '''Cache statistics for monitoring'''
+    if (request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4):
+        return jsonify({'ranking_cache': TEAMS_DAO.ranking_cache_stats(),
+                        'scoreboard_snapshot_builds': SCOREBOARD.builds,
+                        'identity_cache': IDENTITIES.stats(),
+                        'token_cache': TOKENS.stats(),
+                        'db_pool': POOL_STATS.summary(TEAMS_DAO.database)}), 200
+    else:
+        logging.warning(" %s is NOT allowed to request stats" % request.remote_addr)
+        return abort(403)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''Metrics in the Prometheus text format'''
+    if (request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4):
+        sample_cache_stats()
+        return Response(REGISTRY.render(), mimetype=METRICS_CONTENT_TYPE)
+    else:
+        logging.warning(" %s is NOT allowed to request metrics" % request.remote_addr)
+        return abort(403)
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    '''Liveness: the worker handles requests'''
+    return jsonify({"status": "ok"}), 200
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    '''Readiness: the worker is initialized and the database answers'''
+    if not ping(TEAMS_DAO.database.engine):
+        return jsonify({"status": "database unavailable"}), 503
+    return jsonify({"status": "ready"}), 200
+
+
 @app.route('/add_team', methods=['GET', 'POST'])
 def add_teams():
     '''Admin intefacce for adding teams'''
-    global UPDATE_TIME
-
     if not check_auth(session):
         return redirect(url_for('login', next=request.url))
 
     if request.method == 'GET':
-        return render_template('team_form.html')
+        return render('team_form.html')
     if request.method == 'POST':
         team = request.values.get('name')
         image = request.values.get('image')
-        updated = str(bool(request.values.get('updated'))) # 'True' if checkbox set, otherwise 'False'
+        updated = bool(request.values.get('updated')) # True if checkbox set, otherwise False
         logging.info("Request to add team %s with image %s and status %s", team, image, updated)
         # Validate image
         if not image:
@@ -228,12 +589,14 @@ def add_teams():
             return {"message": "Incorrect image format!"}, 500
         try:
             TEAMS_DAO.add_team(team, image, updated)
+            if updated:
+                JOBS.enqueue([image])
             logging.info("Added team %s", team)
         except Exception as e:
             logging.error("Failed to add team %s with image %s and status %s: %s", team, image, updated, e)
             return {"message": "Failed to add team!"}, 500 
-        UPDATE_TIME = datetime.datetime.utcnow()
-        return render_template('success.html'), 200
+        publish_scoreboard()
+        return render('success.html'), 200
 
 
 
@@ -241,14 +604,14 @@ def add_teams():
 @app.route('/login', methods=['GET', "POST"])
 def login():
     if request.method == 'GET':
-        return render_template('login.html')
+        return render('login.html')
     elif request.method == 'POST':
         username = request.values.get('username')
         password = request.values.get('password')
         user = authenticate(username, password)
         if not user:
             logging.warn('Failed login attempt from IP: %s', request.remote_addr)
-            return render_template('404.html'), 404
+            return render('404.html'), 404
         access_token = create_access_token(identity=username, fresh=False)
         response = redirect(request.args.get('next') or url_for('index'))
         session['access_token'] = access_token
@@ -265,12 +628,14 @@ def post_schedule():
         logging.debug("%s is allowed to post schedule", request.remote_addr)
         data = request.json
         logging.info("Received updated schedule")
-        logging.debug("received data: %s" % data)
+        logging.debug("received data: %s", data)
         if not data:
             return jsonify({"message":"Bad request"}), 400
-        for image, timestamp in data.items():
-            TEAMS_DAO.update_image(image, timestamp)
-            logging.debug("image entry %s updated at:  %s" % (image, timestamp))
+        TEAMS_DAO.update_images(data)
+        JOBS.enqueue(data)
+        IMAGES_UPDATED.inc(len(data))
+        logging.debug("image entries updated at: %s", data)
+        publish_scoreboard()
 
         return json.dumps(request.json), 200
     else:
@@ -282,25 +647,125 @@ def post_schedule():
 def get_teams():
     if (request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4 ):
         images = TEAMS_DAO.get_image_statuses()
-        logging.info("sending schedule %s to component: %s" % (images, request.remote_addr))
-        return json.dumps(images)
+        logging.info("sending schedule of %d images to component: %s", len(images), request.remote_addr)
+        logging.debug("schedule: %s", images)
+        # Versioned by content, so components polling for changes get a 304 while nothing changed
+        response = app.response_class(json.dumps(images, sort_keys=True), mimetype='application/json')
+        response.add_etag()
+        return response.make_conditional(request)
     else:
         logging.warning(" %s is NOT allowed to request schedule" % request.remote_addr)
         return abort(403)
 
 
+@app.route('/jobs/lease', methods=['POST'])
+def lease_jobs():
+    '''Hand out the next images to benchmark to a manager: {"worker": name, "count": n}.
+    Each job has to be extended with /jobs/heartbeat before `expires_at` and released with /jobs/complete
+    '''
+    if (request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4 ):
+        data = request.get_json(silent=True) or {}
+        try:
+            count = int(data.get('count', 1))
+        except (TypeError, ValueError):
+            return jsonify({"message":"Bad request"}), 400
+        expire_leases()
+        jobs = JOBS.lease(data.get('worker') or request.remote_addr, count)
+        logging.info("Leased %d jobs to %s", len(jobs), data.get('worker') or request.remote_addr)
+        if jobs:
+            set_team_status({job['image']: 'running' for job in jobs})
+            publish_scoreboard()
+        return Response(to_json({'jobs': jobs}), mimetype='application/json')
+    else:
+        logging.warning(" %s is NOT allowed to lease jobs" % request.remote_addr)
+        return abort(403)
+
+
+@app.route('/jobs/heartbeat', methods=['POST'])
+def heartbeat_job():
+    '''Extend the lease of a running job: {"lease": token}'''
+    if (request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4 ):
+        data = request.get_json(silent=True) or {}
+        if not data.get('lease'):
+            return jsonify({"message":"Bad request"}), 400
+        expires_at = JOBS.heartbeat(data['lease'])
+        if expires_at is None:
+            return jsonify({"message":"Lease expired"}), 409
+        return Response(to_json({'expires_at': expires_at}), mimetype='application/json')
+    else:
+        logging.warning(" %s is NOT allowed to extend leases" % request.remote_addr)
+        return abort(403)
+
+
+@app.route('/jobs/complete', methods=['POST'])
+def complete_job():
+    '''Release a leased job: {"lease": token, "failed": false}. A failed job is queued again'''
+    if (request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4 ):
+        data = request.get_json(silent=True) or {}
+        if not data.get('lease'):
+            return jsonify({"message":"Bad request"}), 400
+        image = JOBS.complete(data['lease'], bool(data.get('failed')))
+        if image is None:
+            return jsonify({"message":"Lease expired"}), 409
+        # Like a posted result, the job leaves the queue or goes back to waiting in it
+        set_team_status({image: ''})
+        publish_scoreboard()
+        return jsonify({"message":"Completed"}), 200
+    else:
+        logging.warning(" %s is NOT allowed to complete jobs" % request.remote_addr)
+        return abort(403)
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    '''Leased and queued jobs, in the order they are handed out'''
+    if not ((request.remote_addr in ALLOWED_HOSTS) or request.remote_addr.startswith( '172', 0, 4) or check_auth(session)):
+        logging.warning(" %s is NOT allowed to list jobs" % request.remote_addr)
+        return abort(403)
+    expire_leases()
+    return Response(to_json({'jobs': [dict(job) for job in JOBS.jobs()]}), mimetype='application/json')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+    REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def remember_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def end_request(exception=None):
+    '''Observe every request here, after_request is skipped for requests that raise'''
+    if 'request_start' in g:
+        REQUESTS_IN_FLIGHT.dec()
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.time() - g.request_start, method=request.method, route=route)
+        status = 500 if exception is not None else g.get('response_status', 500)
+        REQUESTS.inc(method=request.method, route=route, status=status)
+
+
+@app.teardown_request
+def release_db_connection(exception=None):
+    '''Connections are checked out on first use in a request and returned to the pool here'''
+    release_connection(TEAMS_DAO.database)
+
+
 @app.before_request
 def make_session_permanent():
-    session.permanent = True
-    session_timeout_seconds = int(os.getenv("FLASK_SESSION_TIMEOUT_SECONDS", default=60))
-    app.permanent_session_lifetime = datetime.timedelta(seconds=session_timeout_seconds)
+    # The lifetime is set once in PERMANENT_SESSION_LIFETIME
+    if not session.permanent:
+        session.permanent = True
 
 
-if __name__ == '__main__':
-    frontend_backoff = int(os.getenv("FRONTEND_STARTUP_BACKOFF", default=40))
-    logging.warning("Waiting for DB server to start: %s seconds" % frontend_backoff)
-    time.sleep(frontend_backoff)
+logging.info("Ready to serve %.1f seconds after start, %.1f of them waiting for the database",
+             time.time() - START_TIME, DB_WAIT_SECONDS)
 
+if __name__ == '__main__':
     '''
         Use CMD in Dockerfile for production deployment:
             gunicorn -b 0.0.0.0:8080 controller:app
@@ -4,6 +4,7 @@ import getpass
 import re
 import pymysql
 pymysql.install_as_MySQLdb()
+from shared_state import create_state_store
 
 
 def connect_to_db(table):
@@ -32,6 +33,8 @@ def create_user(username, password):
         print( "credentials with name %s already exist" % username)
         return
     table.insert(dict(username=username, password=password))
+    # Makes the controller workers drop their cached identities
+    create_state_store().incr('registrations_version')
     print("User was created successfully")
     return
 
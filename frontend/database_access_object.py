@@ -1,21 +1,133 @@
 import pymysql
 pymysql.install_as_MySQLdb()
 import dataset
+from sqlalchemy import event, case, select, func, and_, or_, text
+from sqlalchemy.exc import OperationalError
 import os
 import sys
 import datetime
-import subprocess
+import threading
 import logging
 import math
+import time
+from shared_state import LocalStateStore
+from ranking import RankingIndex
+from migrations import to_datetime, RESULTS_TABLE
+from metrics import REGISTRY, timed
 
-# scheduler service name for restarting upon new entry
-SCHEDULER_SERVICE_NAME = "scheduler"
+# Upper bound on the age of the in-memory ranking, to pick up changes made directly in the DB
+RANKING_CACHE_TTL_SECONDS = int(os.getenv("RANKING_CACHE_TTL_SECONDS", default=300))
+
+# Number of rows fetched per query when streaming the whole results history
+HISTORY_EXPORT_PAGE_SIZE = 1000
+# Columns of a results history row besides its id, image and arrival time
+HISTORY_COLUMNS = ['last_run', 'total_runtime', 'latency', 'accuracy', 'timeliness', 'tag', 'benchmark_runtime']
+
+# Connection pool of the engine shared by all DB users of the process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", default=5))
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", default=10))
+DB_POOL_TIMEOUT_SECONDS = int(os.getenv("DB_POOL_TIMEOUT_SECONDS", default=30))
+# Recycle connections well before MySQL's wait_timeout closes them on the server side
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", default=1800))
+
+# Database to use instead of the MySQL server configured by the MYSQL_* variables,
+# e.g. sqlite:////tmp/teams.db for local benchmarks
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Startup waits for the DB server, checking every DB_READY_POLL_SECONDS for at most DB_READY_TIMEOUT_SECONDS
+DB_READY_POLL_SECONDS = float(os.getenv("DB_READY_POLL_SECONDS", default=0.5))
+DB_READY_TIMEOUT_SECONDS = float(os.getenv("DB_READY_TIMEOUT_SECONDS", default=120))
+
+# path -> dataset.Database, so that every caller shares one engine and pool
+DATABASES = {}
+DATABASES_LOCK = threading.Lock()
+
+
+class PoolStats:
+
+    def __init__(self):
+        '''Counters of the connection pool, to size it for peak load'''
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def observe_wait(self, seconds):
+        with self.lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def summary(self, db=None):
+        with self.lock:
+            stats = {'connects': self.connects, 'checkouts': self.checkouts, 'checkins': self.checkins,
+                     'wait_seconds_avg': self.wait_seconds_total / self.waits if self.waits else 0.0,
+                     'wait_seconds_max': self.wait_seconds_max}
+        pool = db.engine.pool if db is not None else None
+        for name in ('size', 'checkedout', 'overflow'):
+            if hasattr(pool, name):
+                stats['pool_' + name] = getattr(pool, name)()
+        return stats
+
+
+POOL_STATS = PoolStats()
+DB_OPERATION_SECONDS = REGISTRY.histogram('controller_db_operation_seconds',
+                                          'Duration of the Teams DB operations', ['operation'])
+DB_QUERY_SECONDS = REGISTRY.histogram('controller_db_query_seconds', 'Duration of single SQL statements')
+DB_QUERY_ERRORS = REGISTRY.counter('controller_db_query_errors_total', 'SQL statements that raised an error')
+
+
+def query_started(connection, *args):
+    connection.info.setdefault('query_start', []).append(time.time())
+
+
+def query_finished(connection, *args):
+    DB_QUERY_SECONDS.observe(time.time() - connection.info['query_start'].pop())
+
+
+def query_failed(context):
+    '''after_cursor_execute is not fired for a failed statement, drop its start time here'''
+    DB_QUERY_ERRORS.inc()
+    connection = context.connection
+    if connection is not None and connection.info.get('query_start') and context.execution_context is not None:
+        connection.info['query_start'].pop()
+
+
+def create_database(path):
+    engine_kwargs = {}
+    if not path.startswith('sqlite'):
+        engine_kwargs = dict(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_POOL_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+            pool_recycle=DB_POOL_RECYCLE_SECONDS,
+            # Test connections on checkout, so connections dropped while idle are replaced transparently
+            pool_pre_ping=True,
+        )
+    db = dataset.connect(path, engine_kwargs=engine_kwargs)
+    event.listen(db.engine, 'connect', lambda *args: POOL_STATS.count('connects'))
+    event.listen(db.engine, 'checkout', lambda *args: POOL_STATS.count('checkouts'))
+    event.listen(db.engine, 'checkin', lambda *args: POOL_STATS.count('checkins'))
+    event.listen(db.engine, 'before_cursor_execute', query_started)
+    event.listen(db.engine, 'after_cursor_execute', query_finished)
+    event.listen(db.engine, 'handle_error', query_failed)
+    return db
 
-def restart_scheduler(container_name):
-    subprocess.check_output(['docker', 'restart', container_name])
 
 # generic root connection. To be used separately elsewhere
 def connect_to_db(table, access='user'):
+    if DATABASE_URL:
+        with DATABASES_LOCK:
+            if DATABASE_URL not in DATABASES:
+                DATABASES[DATABASE_URL] = create_database(DATABASE_URL)
+            return DATABASES[DATABASE_URL]
     if 'MYSQL_ROOT_PASSWORD' in os.environ:
         host = os.getenv('MYSQL_HOST')
         port = os.getenv('MYSQL_PORT')
@@ -26,18 +138,88 @@ def connect_to_db(table, access='user'):
             user = os.getenv('MYSQL_USER')
             password = os.getenv('MYSQL_PASSWORD')
         path = 'mysql://'+ user +':'+ password + '@'+ host +':' + str(port) + '/' + table
-        return dataset.connect(path)
+        with DATABASES_LOCK:
+            if path not in DATABASES:
+                DATABASES[path] = create_database(path)
+            return DATABASES[path]
     else:
         raise ValueError('MySQL Environment Variables not set!')
 
+
+def ping(engine):
+    '''Return True if the DB server answers a trivial query'''
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        return True
+    except OperationalError:
+        return False
+
+
+def wait_for_database(engine, timeout=DB_READY_TIMEOUT_SECONDS, interval=DB_READY_POLL_SECONDS):
+    '''Block until the DB server accepts connections. Return the seconds waited'''
+    start = time.time()
+    while not ping(engine):
+        if time.time() - start > timeout:
+            raise RuntimeError('Database not reachable after %d seconds!' % timeout)
+        logging.info('Waiting for the database server')
+        time.sleep(interval)
+    return time.time() - start
+
+
+def checkout_connection(db):
+    '''Check out a pooled connection for the calling thread unless it already holds one.
+    dataset keeps one connection per thread in `db.connections`
+    '''
+    thread = threading.get_ident()
+    if thread in db.connections:
+        return
+    # Check out outside of db.lock: dataset's `executable` holds the lock while waiting for the pool,
+    # which blocks the threads that would return their connections once the pool is exhausted
+    start = time.time()
+    connection = db.engine.connect()
+    POOL_STATS.observe_wait(time.time() - start)
+    with db.lock:
+        db.connections[thread] = connection
+
+
+def release_connection(db):
+    '''Return the calling thread's connection to the pool, e.g. at the end of a request'''
+    if db.in_transaction:
+        return
+    with db.lock:
+        connection = db.connections.pop(threading.get_ident(), None)
+    if connection is not None:
+        connection.close()
+
+
 class Teams:
-    def __init__(self, table):
+    def __init__(self, table, state=None, engine=None):
         self.table = table
         self.connect_to_db(self.table)
+        # The ranking is kept in memory and updated incrementally by writes through this object.
+        # Every write increments 'ranking_version' in the (shared) state store,
+        # so a worker reloads the ranking when another worker wrote in between.
+        self.state = state or LocalStateStore()
+        # RankingEngine of a non-default scoring configuration, None for the standard scoreboard
+        self.engine = engine
+        self.ranking_lock = threading.Lock()
+        self.ranking_index = None
+        self.ranking_loaded_at = 0
+        self.ranking_version = None
+        self.ranking_cache_hits = 0
+        self.ranking_cache_misses = 0
 
     def connect_to_db(self, table):
-      self.db = connect_to_db(table) 
+      self.database = connect_to_db(table)
+
+    @property
+    def db(self):
+        '''The database, with a pooled connection checked out for the calling thread'''
+        checkout_connection(self.database)
+        return self.database
 
+    @timed(DB_OPERATION_SECONDS, operation='add_team')
     def add_team(self, name, image, status):
         table = self.db[self.table]
         row = table.find_one(name=name)
@@ -46,15 +228,36 @@ class Teams:
             table.update(dict(name=name, image=image, updated=status), ['name'])
         else:
             logging.info('Inserting new entry for team %s' % name)
-            table.insert(dict(name=name, image=image, updated=status))
-            restart_scheduler(SCHEDULER_SERVICE_NAME)
+            # The scheduler picks up the new image on its next schedule reload
+            team_id = table.insert(dict(name=name, image=image, updated=status))
+            self.update_ranking(lambda index: index.insert(dict(id=team_id, name=name, image=image, updated=status)))
+            return
+        self.update_ranking(lambda index: index.update(index.find('name', name), dict(image=image, updated=status)))
 
     def update_image(self, image_name, timestamp):
-        table = self.db[self.table]
-        table.update(dict(image=image_name,  time_tag=timestamp, updated='True'), ['image'])
+        self.update_images({image_name: timestamp})
+
+    @timed(DB_OPERATION_SECONDS, operation='update_images')
+    def update_images(self, images):
+        '''Mark all images of the image -> timestamp dictionary as updated
+        with a single UPDATE ... CASE statement in one transaction
+        '''
+        if not images:
+            return
+        start = time.time()
+        rows = {image: dict(time_tag=to_datetime(timestamp), updated=True) for image, timestamp in images.items()}
+        self.bulk_update(rows)
+        self.update_ranking(lambda index: self.update_ranking_rows(index, rows))
+        logging.info("Updated %d images in %.1f ms", len(images), (time.time() - start) * 1000)
 
     def update_result(self, result):
-            '''
+        self.update_results([result])
+
+    @timed(DB_OPERATION_SECONDS, operation='update_results')
+    def update_results(self, results):
+            '''Store a batch of results with a single UPDATE ... CASE statement in one transaction,
+            which also appends every result to the `results` history table.
+            Each result has the fields:
             image
             --- Score ---
             total_runtime
@@ -66,18 +269,49 @@ class Teams:
             tag
             last_run
             '''
-            table = self.db[self.table]
-            table.update(dict(image=result['image'],
-                total_runtime = self.fininte_or_none(result['total_runtime']),
-                latency = self.fininte_or_none(result['latency']),
-                accuracy = self.fininte_or_none(result['accuracy']),
-                timeliness = self.fininte_or_none(result['timeliness']),
-                tag=result['tag'],
-                last_run=result['last_run'],
-                benchmark_runtime=result['benchmark_runtime'],
-                updated=str(False),
-            ), ['image'])
-            logging.info("Result updated for image %s", result['image'])
+            if not results:
+                return
+            start = time.time()
+            received_at = datetime.datetime.utcnow()
+            rows = {}
+            history = []
+            for result in results:
+                rows[result['image']] = dict(
+                    total_runtime = self.fininte_or_none(result['total_runtime']),
+                    latency = self.fininte_or_none(result['latency']),
+                    accuracy = self.fininte_or_none(result['accuracy']),
+                    timeliness = self.fininte_or_none(result['timeliness']),
+                    tag=result['tag'],
+                    last_run=to_datetime(result['last_run']),
+                    benchmark_runtime=result['benchmark_runtime'],
+                    updated=False,
+                )
+                history.append(dict({column: rows[result['image']][column] for column in HISTORY_COLUMNS},
+                                    image=result['image'], received_at=received_at))
+            self.bulk_update(rows, history)
+            self.update_ranking(lambda index: self.update_ranking_rows(index, rows))
+            logging.info("Results updated for images %s in %.1f ms", list(rows), (time.time() - start) * 1000)
+
+    def bulk_update(self, rows, history=None):
+        '''Apply the image -> {column: value} updates in one statement:
+        UPDATE teams SET column = CASE image WHEN ... THEN ... END, ... WHERE image IN (...)
+        All rows must have the same columns. The `history` rows are inserted into the
+        results table in the same transaction.
+        '''
+        table = self.db[self.table]
+        example = next(iter(rows.values()))
+        # Columns are created on demand, like dataset does for single row updates
+        for column, value in example.items():
+            if not table.has_column(column):
+                table.create_column_by_example(column, value)
+        image_column = table.table.c.image
+        values = {column: case({image: row[column] for image, row in rows.items()}, value=image_column)
+                  for column in example}
+        statement = table.table.update().where(image_column.in_(list(rows))).values(values)
+        with self.db as db:
+            db.executable.execute(statement)
+            if history:
+                db[RESULTS_TABLE].insert_many(history, ensure=False)
 
     def fininte_or_none(self, value):
         try:
@@ -86,6 +320,7 @@ class Teams:
             logging.error(e)
             return None
 
+    @timed(DB_OPERATION_SECONDS, operation='get_image_statuses')
     def get_image_statuses(self):
         '''Return dictionary of image -> status (updated/old) for all images in DB
         '''
@@ -101,7 +336,7 @@ class Teams:
                     logging.warn('Igoring image with incorrect format: "%s". Format is {team_repo/team_image}.' % image)
                     continue
                 # Populate dict
-                if row['updated'] == 'True':
+                if row['updated']:
                     images[image] = 'updated'
                 else:
                     images[image] = 'old'
@@ -109,6 +344,7 @@ class Teams:
                 logging.info('Ignoring team "%s": no image specified', row['name'])
         return images
 
+    @timed(DB_OPERATION_SECONDS, operation='get_team_data')
     def get_team_data(self, image, columns):
         table = self.db[self.table] 
         teamData = table.find_one(image=image)
@@ -116,57 +352,94 @@ class Teams:
             return {}
         return {k: v for (k, v) in teamData.items() if k in columns} 
 
+    def get_history(self, image, limit, after=None):
+        '''Return an iterator over at most `limit` results of the image, ordered by (last_run, id).
+        `after` is the (last_run, id) of the last result of the previous page.
+        '''
+        results = self.db[RESULTS_TABLE].table
+        statement = select(results).where(results.c.image == image, results.c.last_run.isnot(None))
+        if after is not None:
+            last_run, result_id = after
+            statement = statement.where(or_(results.c.last_run > last_run,
+                                            and_(results.c.last_run == last_run, results.c.id > result_id)))
+        return self.db.query(statement.order_by(results.c.last_run, results.c.id).limit(limit))
+
+    def iter_history(self, page_size=HISTORY_EXPORT_PAGE_SIZE, after=0):
+        '''Generate all results with an id greater than `after` in insertion order, fetching one page at a time'''
+        results = self.db[RESULTS_TABLE].table
+        last_id = after
+        while True:
+            page = list(self.db.query(select(results).where(results.c.id > last_id).order_by(results.c.id).limit(page_size)))
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            last_id = page[-1]['id']
+
+    def get_ranking_rows(self, at=None):
+        '''Return the rows of the current ranking, or of the ranking at time `at`, for re-ranking'''
+        rows, _, _ = self.get_ranking_at(at) if at is not None else self.get_ranking()
+        return rows
+
+    @timed(DB_OPERATION_SECONDS, operation='get_ranking_at')
+    def get_ranking_at(self, at):
+        '''Return the ranking as it stood at time `at`, from the latest result of each team
+        with last_run <= at, in the same format as get_ranking()
+        '''
+        results = self.db[RESULTS_TABLE].table
+        teams = self.db[self.table].table
+        position = func.row_number().over(partition_by=results.c.image,
+                                          order_by=(results.c.last_run.desc(), results.c.id.desc()))
+        latest = select(results, position.label('position')).where(results.c.last_run <= at).subquery()
+        statement = (select(teams.c.id, teams.c.name, latest.c.image, *[latest.c[column] for column in HISTORY_COLUMNS])
+                     .select_from(latest.join(teams, teams.c.image == latest.c.image))
+                     .where(latest.c.position == 1))
+        return RankingIndex(self.db.query(statement), self.engine).ranked()
+
+    def update_ranking(self, apply):
+        '''Apply a write to the in-memory ranking with `apply(index)` and announce it to other workers.
+        If another worker wrote since the ranking was loaded, it is dropped and reloaded on the next read.
+        '''
+        with self.ranking_lock:
+            version = self.state.incr('ranking_version')
+            if self.ranking_index is not None and self.ranking_version == version - 1:
+                apply(self.ranking_index)
+                self.ranking_version = version
+            else:
+                self.ranking_index = None
+
+    def update_ranking_rows(self, index, rows):
+        for image, changes in rows.items():
+            index.update(index.find('image', image), changes)
+
+    def ranking_cache_stats(self):
+        with self.ranking_lock:
+            return {'hits': self.ranking_cache_hits, 'misses': self.ranking_cache_misses,
+                    'version': self.ranking_version, 'cached': self.ranking_index is not None}
+
+    @timed(DB_OPERATION_SECONDS, operation='get_ranking')
     def get_ranking(self):
         '''Return a tuple (table, last_experiment_time, waiting_time), 
-        where "table" is the team entries sorted on their score
+        where "table" is the team entries sorted on their score.
+        The ranking is served from memory, it is only loaded from the DB (with a single scan)
+        at startup, when another worker changed the table or when it is older than the TTL.
         '''
-        teams_unranked = self.db[self.table].all()
-        failover_ranking = (teams_unranked, "", 0)
-        if not self.verify_schema(teams_unranked, 'total_runtime'):
-            logging.error("Database schema verification failed! It this is the first run make sure that DB is initialized")
-            return failover_ranking
-
-        ranking_query = '''SELECT *, (R.rank_total_runtime+R.rank_latency+R.rank_timeliness+R.rank_accuracy) as total_rank FROM 
-            %s AS T INNER JOIN 
-                (SELECT id, 
-                dense_rank() OVER (ORDER BY IFNULL(total_runtime, 1E10) ASC) AS rank_total_runtime,
-                dense_rank() OVER (ORDER BY IFNULL(latency, 1E10) ASC) AS rank_latency,
-                dense_rank() OVER (ORDER BY IFNULL(timeliness, 0) DESC) AS rank_timeliness,
-                dense_rank() OVER (ORDER BY IFNULL(accuracy, 0) DESC) AS rank_accuracy
-                FROM %s) AS R
-                ON T.id = R.id
-            ORDER BY total_rank ASC
-                ''' % (self.table, self.table)
-        last_experiment_time_query = 'SELECT MAX(last_run) AS result FROM %s' % self.table
-        max_runtime_query = 'SELECT MAX(benchmark_runtime) AS result FROM %s' % self.table
+        version = self.state.get('ranking_version', 0)
+        with self.ranking_lock:
+            if (self.ranking_index is not None and self.ranking_version == version
+                    and time.time() - self.ranking_loaded_at < RANKING_CACHE_TTL_SECONDS):
+                self.ranking_cache_hits += 1
+                return self.ranking_index.ranked()
+            self.ranking_cache_misses += 1
         try:
-            ranking = self.db.query(ranking_query)
+            index = RankingIndex(self.db[self.table].all(), self.engine)
         except Exception as e:
             logging.error("Failed to retrieve rankings. If this is the first run make sure that DB is initialized: %s", e)
-            return failover_ranking
-        last_experiment_time = self.single_result_or_default(last_experiment_time_query, 'result', 0)
-        max_runtime = self.single_result_or_default(max_runtime_query, 'result', 0)
-        return (ranking, last_experiment_time, max_runtime)
-
-    def verify_schema(self, table, test_column):
-        if not list(table):
-            return False
-        for team in table:
-            try:
-                team[test_column]
-            except KeyError:
-                return False
-        return True
-
-    def single_result_or_default(self, query, column, default, *_clauses, **kwargs):
-        result = default
-        try:
-            rows = self.db.query(query, *_clauses, **kwargs)
-            for i, row in enumerate(rows):
-                result = row[column]
-            if i > 1:
-                raise ValueError('query "%s" returned multiple results!')
-            return result
-        except Exception as e:
-            logging.error("Failed to execute '%s' metadata: %s", query, e)
-            return default
+            return ([], "", 0)
+        with self.ranking_lock:
+            # Do not keep a ranking that a concurrent write has already made stale
+            if version == self.state.get('ranking_version', 0):
+                self.ranking_index = index
+                self.ranking_version = version
+                self.ranking_loaded_at = time.time()
+            return index.ranked()
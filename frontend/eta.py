@@ -0,0 +1,92 @@
+import os
+import heapq
+import datetime
+import threading
+from metrics import REGISTRY
+
+# Weight of the latest run in the moving average of the runtime of an image
+ETA_EWMA_ALPHA = float(os.getenv("ETA_EWMA_ALPHA", default=0.3))
+# Upper bounds (seconds) of the prediction error histogram buckets
+ERROR_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+RUNTIME_PREDICTION_ERROR = REGISTRY.histogram(
+        'controller_runtime_prediction_error_seconds', 'Absolute error of the predicted benchmark runtime of an image',
+        buckets=ERROR_BUCKETS)
+ETA_PREDICTION_ERROR = REGISTRY.histogram(
+        'controller_eta_prediction_error_seconds', 'Absolute error of the last queue ETA shown for an image',
+        buckets=ERROR_BUCKETS)
+
+
+class RuntimeEstimator:
+
+    def __init__(self, alpha=ETA_EWMA_ALPHA):
+        '''Exponentially weighted moving average of the benchmark runtime of every image,
+        and of all images for the ones that never ran. Fed from the results table,
+        so that every worker learns from the results received by the others.
+        '''
+        self.alpha = alpha
+        self.averages = {}  # image -> average runtime in seconds
+        self.overall = None
+        self.last_id = 0  # Last results row applied
+        self.predictions = {}  # image -> last ETA forecast
+        self.finished_at = None  # Time the last result was received
+        self.lock = threading.Lock()
+
+    def catch_up(self, rows):
+        '''Apply the results rows (id, image, benchmark_runtime, received_at) newer than the last applied one'''
+        with self.lock:
+            # The errors of the predictions are not measured while warming up from the history
+            record = self.last_id > 0
+            for row in rows:
+                if row['id'] <= self.last_id:
+                    continue
+                self.last_id = row['id']
+                self.observe(row['image'], row['benchmark_runtime'], row['received_at'], record)
+
+    def observe(self, image, seconds, finished_at=None, record=True):
+        if finished_at is not None and (self.finished_at is None or finished_at > self.finished_at):
+            self.finished_at = finished_at
+        predicted_eta = self.predictions.pop(image, None)
+        if record and predicted_eta is not None and finished_at is not None:
+            ETA_PREDICTION_ERROR.observe(abs((finished_at - predicted_eta).total_seconds()))
+        if seconds is None or seconds <= 0:
+            return
+        average = self.averages.get(image)
+        if record and average is not None:
+            RUNTIME_PREDICTION_ERROR.observe(abs(seconds - average))
+        self.averages[image] = seconds if average is None else average + self.alpha * (seconds - average)
+        self.overall = seconds if self.overall is None else self.overall + self.alpha * (seconds - self.overall)
+
+    def estimate(self, image, default):
+        '''Expected runtime of the image in seconds'''
+        average = self.averages.get(image, self.overall)
+        return average if average is not None else default
+
+    def forecast(self, jobs, default):
+        '''Return [(image, eta)] of the leased and queued jobs, in queue order.
+        Every manager leasing a job runs one at a time, the queued jobs go to the first one to be free.
+        The ETAs only depend on stored times: the start of the leases, the time the jobs were queued
+        and the last result received, so they do not change until the queue or the results do.
+        `default` is the runtime in seconds of images when nothing ran yet.
+        '''
+        with self.lock:
+            slots = {}  # manager -> time it is free
+            etas = []
+            queued = []
+            for job in jobs:
+                if job['state'] != 'leased':
+                    queued.append(job)
+                    continue
+                started = job['leased_at'] or job['enqueued_at'] or self.finished_at or datetime.datetime.min
+                eta = started + datetime.timedelta(seconds=self.estimate(job['image'], default))
+                slots[job['leased_by']] = max(eta, slots.get(job['leased_by'], eta))
+                etas.append((job['image'], eta))
+            free = sorted(slots.values()) or [self.finished_at or datetime.datetime.min]
+            for job in queued:
+                # A job starts once a manager is free, but not before it was queued
+                started = max(heapq.heappop(free), job['enqueued_at'] or datetime.datetime.min)
+                eta = started + datetime.timedelta(seconds=self.estimate(job['image'], default))
+                heapq.heappush(free, eta)
+                etas.append((job['image'], eta))
+            self.predictions.update(etas)
+            return etas
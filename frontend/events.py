@@ -0,0 +1,69 @@
+import os
+import threading
+import collections
+from scoreboard import to_json
+
+# Number of past events kept for clients that reconnect or long-poll
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", default=256))
+
+
+class EventBroker:
+
+    def __init__(self, capacity=EVENT_BUFFER_SIZE):
+        '''Ring buffer of scoreboard deltas shared by all watchers.
+        A delta is computed and serialized once per change, watchers only
+        wait on a condition and read from the buffer, they never touch the DB.
+        '''
+        self.condition = threading.Condition()
+        self.events = collections.deque(maxlen=capacity)  # (id, event_type, json data)
+        self.last_id = 0
+        self.rows = {}  # team name -> last published public ranking row
+        self.queue = collections.OrderedDict()  # team name -> last published queue entry
+
+    def publish_scoreboard(self, ranking, queue):
+        '''Publish the rows of `ranking` and `queue` that differ from the last published state'''
+        rows = {}
+        for position, row in ranking.items():
+            rows[row.get('name')] = dict(row, position=position)
+        new_queue = collections.OrderedDict()
+        for entry in queue:
+            new_queue.update(entry)
+        with self.condition:
+            changed = [row for name, row in rows.items() if self.rows.get(name) != row]
+            removed = [name for name in self.rows if name not in rows]
+            if changed or removed:
+                self._append('ranking', {'changed': changed, 'removed': removed})
+            if new_queue != self.queue:
+                queue_changed = {name: entry for name, entry in new_queue.items() if self.queue.get(name) != entry}
+                self._append('queue', {'order': list(new_queue), 'changed': queue_changed})
+            self.rows = rows
+            self.queue = new_queue
+
+    def snapshot(self):
+        '''Return (last_id, full state) to initialize a new watcher'''
+        with self.condition:
+            ranking = sorted(self.rows.values(), key=lambda row: row['position'])
+            return self.last_id, to_json({'ranking': ranking, 'order': list(self.queue), 'queue': self.queue})
+
+    def wait(self, last_id, timeout):
+        '''Block until there are events newer than `last_id` or `timeout` expires.
+        Return the list of new events, or None if some of them were already dropped
+        from the buffer and the watcher has to start over from a snapshot.
+        '''
+        with self.condition:
+            if last_id > self.last_id:
+                # Event id from before a restart
+                return None
+            self.condition.wait_for(lambda: self.last_id > last_id, timeout)
+            if self.last_id > last_id and (not self.events or self.events[0][0] > last_id + 1):
+                return None
+            return [event for event in self.events if event[0] > last_id]
+
+    def _append(self, event_type, data):
+        self.last_id += 1
+        self.events.append((self.last_id, event_type, to_json(data)))
+        self.condition.notify_all()
+
+
+def format_sse(event_id, event_type, data):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (event_id, event_type, data)
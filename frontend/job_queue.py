@@ -0,0 +1,226 @@
+import os
+import uuid
+import logging
+import datetime
+import threading
+from sqlalchemy import select, and_
+from migrations import JOBS_TABLE
+from database_access_object import checkout_connection
+from shared_state import LocalStateStore
+from metrics import REGISTRY
+
+# How long a manager may run a leased image without a heartbeat before it is queued again
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", default=15 * 60))
+# Maximum number of jobs handed out by a single lease request
+JOB_MAX_LEASE_COUNT = 10
+# Queued candidates tried per lease request before giving up on a contended queue
+JOB_CLAIM_ATTEMPTS = 5
+
+JOBS_LEASED = REGISTRY.counter('controller_jobs_leased_total', 'Benchmark jobs handed out to managers')
+JOB_CLAIM_CONFLICTS = REGISTRY.counter('controller_job_claim_conflicts_total', 'Job claims lost to a concurrent lease request')
+JOBS_EXPIRED = REGISTRY.counter('controller_jobs_expired_total', 'Leases that expired and were queued again')
+JOBS_COMPLETED = REGISTRY.counter('controller_jobs_completed_total', 'Leased jobs completed by managers', ['outcome'])
+
+
+class JobQueue:
+
+    def __init__(self, database, lease_seconds=JOB_LEASE_SECONDS, clock=datetime.datetime.utcnow, state=None):
+        '''Queue of the images to benchmark, shared by all workers through the jobs table.
+        A job is queued, leased by a manager until its lease expires, or done.
+        Managers claim jobs with a conditional UPDATE, so concurrent lease requests never get the same image.
+        The leased and queued jobs are mirrored in memory for the readers. Every write re-reads the rows
+        it changed and increments 'jobs_version' in the (shared) state store,
+        so a worker reloads the mirror when another worker wrote in between.
+        '''
+        self.database = database
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        self.state = state or LocalStateStore()
+        self.cache_lock = threading.Lock()
+        self.cache = None  # image -> job of the leased and queued jobs
+        self.cache_version = None
+        self.ordered = None  # jobs of the cache in queue order, dropped on writes
+
+    @property
+    def db(self):
+        checkout_connection(self.database)
+        return self.database
+
+    @property
+    def table(self):
+        return self.db[JOBS_TABLE].table
+
+    def execute(self, statement):
+        '''Execute a write in its own transaction, return the number of matched rows'''
+        with self.db as db:
+            return db.executable.execute(statement).rowcount
+
+    def enqueue(self, images, priority=0):
+        '''Queue the images of the iterable. An image already queued keeps its place,
+        a leased one is queued again once its current run completes
+        '''
+        images = list(images)
+        if not images:
+            return
+        jobs = self.table
+        now = self.clock()
+        with self.db as db:
+            db.executable.execute(jobs.update().where(jobs.c.image.in_(images), jobs.c.state == 'done')
+                                  .values(state='queued', priority=priority, enqueued_at=now))
+            db.executable.execute(jobs.update().where(jobs.c.image.in_(images), jobs.c.state == 'leased')
+                                  .values(pending=True))
+            existing = set(row[0] for row in db.executable.execute(select(jobs.c.image).where(jobs.c.image.in_(images))))
+            new_jobs = [dict(image=image, state='queued', priority=priority, pending=False, enqueued_at=now, attempts=0)
+                        for image in images if image not in existing]
+            if new_jobs:
+                db.executable.execute(jobs.insert(), new_jobs)
+        self.refresh(jobs.c.image.in_(images))
+
+    def settle(self, images):
+        '''Mark the queued images as done, for results of runs that were not leased through the queue'''
+        images = list(images)
+        jobs = self.table
+        self.execute(jobs.update().where(jobs.c.image.in_(images), jobs.c.state == 'queued').values(state='done'))
+        self.refresh(jobs.c.image.in_(images))
+
+    def requeue_expired(self):
+        '''Queue the jobs whose lease expired again, in their original place. Return their images.
+        The DB is only queried when a lease in the in-memory mirror expired
+        '''
+        now = self.clock()
+        if not any(job['state'] == 'leased' and job['lease_expires_at'] is not None and job['lease_expires_at'] < now
+                   for job in self.snapshot()[0]):
+            return []
+        jobs = self.table
+        expired = list(self.db.executable.execute(
+            select(jobs.c.id, jobs.c.image).where(jobs.c.state == 'leased', jobs.c.lease_expires_at < now)))
+        if not expired:
+            return []
+        requeued = self.execute(jobs.update().where(jobs.c.id.in_([job_id for job_id, _ in expired]), jobs.c.state == 'leased',
+                                                    jobs.c.lease_expires_at < now)
+                                .values(state='queued', lease_token=None, leased_by=None, leased_at=None, lease_expires_at=None))
+        if requeued:
+            JOBS_EXPIRED.inc(requeued)
+            logging.warning('Queued %d jobs with expired leases again', requeued)
+        self.refresh(jobs.c.id.in_([job_id for job_id, _ in expired]))
+        return [image for _, image in expired]
+
+    def lease(self, worker, count=1):
+        '''Lease up to `count` jobs to `worker`, highest priority then oldest first.
+        Return a list of {image, lease, expires_at}. Expired leases are not reclaimed here, the caller
+        runs requeue_expired() first to clear the status of the images it returns
+        '''
+        jobs = self.table
+        leased = []
+        count = max(1, min(count, JOB_MAX_LEASE_COUNT))
+        for _ in range(JOB_CLAIM_ATTEMPTS):
+            candidates = list(self.db.executable.execute(
+                select(jobs.c.id, jobs.c.image).where(jobs.c.state == 'queued')
+                .order_by(jobs.c.priority.desc(), jobs.c.enqueued_at, jobs.c.id).limit(count - len(leased))))
+            if not candidates:
+                break
+            for job_id, image in candidates:
+                token = uuid.uuid4().hex
+                now = self.clock()
+                expires_at = now + datetime.timedelta(seconds=self.lease_seconds)
+                claimed = self.execute(jobs.update().where(jobs.c.id == job_id, jobs.c.state == 'queued').values(
+                    state='leased', pending=False, lease_token=token, leased_by=worker, leased_at=now,
+                    lease_expires_at=expires_at, attempts=jobs.c.attempts + 1))
+                if claimed:
+                    leased.append({'image': image, 'lease': token, 'expires_at': expires_at})
+                else:
+                    JOB_CLAIM_CONFLICTS.inc()
+            if len(leased) == count:
+                break
+        JOBS_LEASED.inc(len(leased))
+        if leased:
+            self.refresh(jobs.c.image.in_([job['image'] for job in leased]))
+        return leased
+
+    def heartbeat(self, token):
+        '''Extend a lease, return its new expiry time or None if the lease was lost'''
+        jobs = self.table
+        expires_at = self.clock() + datetime.timedelta(seconds=self.lease_seconds)
+        extended = self.execute(jobs.update().where(jobs.c.lease_token == token, jobs.c.state == 'leased')
+                                .values(lease_expires_at=expires_at))
+        if not extended:
+            return None
+        self.refresh(jobs.c.lease_token == token)
+        return expires_at
+
+    def complete(self, token, failed=False):
+        '''Release a lease. The job is done, unless the run failed or the image was updated
+        during the run, in which case it is queued again at the back.
+        Return the image of the job, None if the lease was lost
+        '''
+        jobs = self.table
+        image = self.db.executable.execute(select(jobs.c.image).where(jobs.c.lease_token == token)).scalar()
+        if image is None:
+            return None
+        released = dict(lease_token=None, leased_by=None, leased_at=None, lease_expires_at=None)
+        leased = and_(jobs.c.lease_token == token, jobs.c.state == 'leased')
+        requeue = leased if failed else and_(leased, jobs.c.pending == True)
+        if self.execute(jobs.update().where(requeue).values(state='queued', pending=False, enqueued_at=self.clock(), **released)):
+            JOBS_COMPLETED.inc(outcome='failed' if failed else 'requeued')
+        elif self.execute(jobs.update().where(leased).values(state='done', **released)):
+            JOBS_COMPLETED.inc(outcome='done')
+        else:
+            return None
+        self.refresh(jobs.c.image == image)
+        return image
+
+    def select_jobs(self):
+        jobs = self.table
+        return select(jobs.c.id, jobs.c.image, jobs.c.state, jobs.c.priority, jobs.c.pending, jobs.c.enqueued_at,
+                      jobs.c.attempts, jobs.c.leased_by, jobs.c.leased_at, jobs.c.lease_expires_at)
+
+    def jobs(self):
+        '''Return the leased and queued jobs from the DB, in the order they are handed out'''
+        jobs = self.table
+        statement = (self.select_jobs().where(jobs.c.state != 'done')
+                     # 'leased' sorts before 'queued'
+                     .order_by(jobs.c.state, jobs.c.priority.desc(), jobs.c.enqueued_at, jobs.c.id))
+        return [dict(row) for row in self.db.query(statement)]
+
+    def refresh(self, condition):
+        '''Announce a write to the other workers and apply the rows matching `condition` to the mirror.
+        If another worker wrote since the mirror was loaded, it is dropped and reloaded on the next read.
+        '''
+        with self.cache_lock:
+            # Read under the lock, so that the rows of concurrent writes are applied in the order they were read
+            rows = [dict(row) for row in self.db.query(self.select_jobs().where(condition))]
+            version = self.state.incr('jobs_version')
+            if self.cache is not None and self.cache_version == version - 1:
+                for row in rows:
+                    if row['state'] == 'done':
+                        self.cache.pop(row['image'], None)
+                    else:
+                        self.cache[row['image']] = row
+                self.cache_version = version
+                self.ordered = None
+            else:
+                self.cache = None
+
+    def snapshot(self):
+        '''Return (jobs, loaded): the leased and queued jobs in the order they are handed out,
+        served from memory. `loaded` is True if they were (re)loaded from the DB,
+        at startup or because another worker changed the queue
+        '''
+        version = self.state.get('jobs_version', 0)
+        with self.cache_lock:
+            if self.cache is not None and self.cache_version == version:
+                if self.ordered is None:
+                    self.ordered = sorted(self.cache.values(), key=queue_order)
+                return self.ordered, False
+        jobs = self.jobs()
+        with self.cache_lock:
+            # Do not keep a mirror that a concurrent write has already made stale
+            if version == self.state.get('jobs_version', 0):
+                self.cache = {job['image']: job for job in jobs}
+                self.cache_version = version
+                self.ordered = jobs
+        return jobs, True
+
+
+def queue_order(job):
+    return (job['state'] != 'leased', -job['priority'], job['enqueued_at'] or datetime.datetime.min, job['id'])
@@ -0,0 +1,66 @@
+import os
+import json
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", default="INFO").upper()
+# queue: records are handed to a background thread that formats and writes them
+# sync: records are written by the logging thread itself
+LOG_MODE = os.getenv("LOG_MODE", default="queue")
+# text or json (one JSON object per line)
+LOG_FORMAT = os.getenv("LOG_FORMAT", default="text")
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(threadName)s -  %(levelname)s - %(message)s'
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        '''Enqueue the record as is. Unlike QueueHandler, the message is not formatted
+        by the logging thread but by the listener, so it costs the caller nothing more than a put.
+        Arguments must therefore not be mutated after logging them.
+        '''
+        return record
+
+
+def configure_logging(folder, filename, level=LOG_LEVEL, mode=LOG_MODE, log_format=LOG_FORMAT):
+    '''Configure the root logger to write to a daily rotated file in `folder` and to stderr.
+    Return the QueueListener writing the records in queue mode, None otherwise
+    '''
+    os.makedirs(folder, exist_ok=True)
+    formatter = JSONFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [TimedRotatingFileHandler(os.path.join(folder, filename), when="midnight", interval=1),
+                logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    listener = None
+    if mode == 'queue':
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        # Flush the pending records on exit
+        atexit.register(listener.stop)
+        handlers = [DeferredQueueHandler(records)]
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+    return listener
@@ -0,0 +1,282 @@
+import math
+import logging
+import datetime
+import contextlib
+from sqlalchemy import (
+        MetaData, Table, Column, Index, Integer, String, Text, Boolean, DateTime, Float, inspect, text, select, func
+        )
+from sqlalchemy.dialects import mysql
+
+TEAMS_TABLE = 'teams'
+RESULTS_TABLE = 'results'
+JOBS_TABLE = 'jobs'
+SCHEMA_VERSION_TABLE = 'schema_version'
+# Name of the MySQL advisory lock taken while migrating, so that concurrently starting workers wait
+MIGRATION_LOCK_NAME = 'teams_schema_migration'
+MIGRATION_LOCK_TIMEOUT_SECONDS = 60
+
+DOUBLE = Float(precision=53).with_variant(mysql.DOUBLE(), 'mysql')
+# Suffix of the typed copy of a column while it is converted
+MIGRATED_SUFFIX = '_migrated'
+# Formats of the timestamps stored as strings before the columns were typed
+LEGACY_TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%fZ']
+
+
+def teams_columns():
+    return [
+        Column('id', Integer, primary_key=True),
+        Column('name', String(255)),
+        Column('image', String(255)),
+        Column('updated', Boolean),
+        Column('time_tag', DateTime),
+        Column('total_runtime', DOUBLE),
+        Column('latency', DOUBLE),
+        Column('accuracy', DOUBLE),
+        Column('timeliness', DOUBLE),
+        Column('tag', Text),
+        Column('last_run', DateTime),
+        Column('benchmark_runtime', DOUBLE),
+    ]
+
+
+def to_boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1')
+    return bool(value)
+
+
+def to_datetime(value):
+    '''Convert a stored or received timestamp to a datetime, None if it can not be parsed'''
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    for time_format in LEGACY_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(str(value), time_format)
+        except ValueError:
+            continue
+    logging.warning('Dropping unparsable timestamp "%s"', value)
+    return None
+
+
+def to_double(value):
+    try:
+        value = float(value)
+        return value if math.isfinite(value) else None
+    except (TypeError, ValueError):
+        return None
+
+
+def to_string(value):
+    return None if value is None else str(value)
+
+
+def converter(column_type):
+    if isinstance(column_type, Boolean):
+        return to_boolean
+    if isinstance(column_type, DateTime):
+        return to_datetime
+    if isinstance(column_type, Float):
+        return to_double
+    return to_string
+
+
+def migration_1_typed_teams_table(connection):
+    '''Create the teams table with native column types, or convert the table created
+    implicitly by dataset (TEXT timestamps, 'True'/'False' strings, FLOAT scores)
+    '''
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    if not inspect(connection).has_table(TEAMS_TABLE):
+        Table(TEAMS_TABLE, MetaData(), *teams_columns()).create(connection)
+        return
+    existing = {column['name']: column['type'] for column in inspect(connection).get_columns(TEAMS_TABLE)}
+    for column in teams_columns():
+        target_type = column.type.compile(dialect=dialect)
+        if column.name not in existing and column.name + MIGRATED_SUFFIX in existing:
+            # MySQL commits every ALTER TABLE, a failed conversion may have dropped the column already
+            logging.info('Resuming the conversion of column %s', column.name)
+            connection.execute(text('ALTER TABLE %s RENAME COLUMN %s TO %s' % (
+                quote(TEAMS_TABLE), quote(column.name + MIGRATED_SUFFIX), quote(column.name))))
+        elif column.name not in existing:
+            logging.info('Adding column %s %s', column.name, target_type)
+            connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (quote(TEAMS_TABLE), quote(column.name), target_type)))
+        elif not column.primary_key and existing[column.name].compile(dialect=dialect) != target_type:
+            logging.info('Converting column %s from %s to %s', column.name, existing[column.name], target_type)
+            retype_column(connection, column.name, target_type, converter(column.type))
+
+
+def retype_column(connection, name, target_type, convert):
+    '''Replace a column by a typed copy: add, copy converted values, drop and rename.
+    The copy left over by a failed conversion is dropped and made again
+    '''
+    quote = connection.dialect.identifier_preparer.quote
+    table, column, new_column = quote(TEAMS_TABLE), quote(name), quote(name + MIGRATED_SUFFIX)
+    if name + MIGRATED_SUFFIX in set(column['name'] for column in inspect(connection).get_columns(TEAMS_TABLE)):
+        logging.warning('Dropping the stale column %s of a failed conversion', name + MIGRATED_SUFFIX)
+        connection.execute(text('ALTER TABLE %s DROP COLUMN %s' % (table, new_column)))
+    connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table, new_column, target_type)))
+    rows = [{'id': row[0], 'value': convert(row[1])}
+            for row in connection.execute(text('SELECT id, %s FROM %s' % (column, table)))]
+    if rows:
+        connection.execute(text('UPDATE %s SET %s = :value WHERE id = :id' % (table, new_column)), rows)
+    connection.execute(text('ALTER TABLE %s DROP COLUMN %s' % (table, column)))
+    connection.execute(text('ALTER TABLE %s RENAME COLUMN %s TO %s' % (table, new_column, column)))
+
+
+def create_indexes(connection, table_name, indexes):
+    '''Create the indexes that do not exist yet. MySQL commits every CREATE INDEX,
+    so the indexes of a failed migration are already there when it is applied again
+    '''
+    existing = set(index['name'] for index in inspect(connection).get_indexes(table_name))
+    for index in indexes:
+        if index.name not in existing:
+            logging.info('Creating index %s', index.name)
+            index.create(connection)
+
+
+def find_duplicates(connection, table, column):
+    '''Return {value: count} of the non-NULL values of the column held by more than one row'''
+    statement = (select(column, func.count()).where(column.isnot(None)).group_by(column)
+                 .having(func.count() > 1).order_by(column))
+    return dict(tuple(row) for row in connection.execute(statement))
+
+
+def migration_2_teams_indexes(connection):
+    '''Unique indexes for the point lookups by image and name,
+    and (column, id) indexes matching the ranking sort keys
+    '''
+    table = Table(TEAMS_TABLE, MetaData(), *teams_columns())
+    # Checked before any index is created, so that the migration fails without side effects
+    duplicates = {column.name: find_duplicates(connection, table, column) for column in (table.c.image, table.c.name)}
+    duplicates = {column: values for column, values in duplicates.items() if values}
+    if duplicates:
+        for column, values in duplicates.items():
+            logging.error('Teams sharing the same %s (value: rows): %s', column, values)
+        raise RuntimeError('Can not create the unique indexes of the teams table, remove the duplicate %s first!'
+                           % ' and '.join(sorted(duplicates)))
+    create_indexes(connection, TEAMS_TABLE, [
+        Index('ux_teams_image', table.c.image, unique=True),
+        Index('ux_teams_name', table.c.name, unique=True),
+        Index('ix_teams_total_runtime', table.c.total_runtime, table.c.id),
+        Index('ix_teams_latency', table.c.latency, table.c.id),
+        Index('ix_teams_timeliness', table.c.timeliness, table.c.id),
+        Index('ix_teams_accuracy', table.c.accuracy, table.c.id),
+        Index('ix_teams_last_run', table.c.last_run),
+        Index('ix_teams_benchmark_runtime', table.c.benchmark_runtime),
+    ])
+
+
+def results_columns():
+    return [
+        Column('id', Integer, primary_key=True),
+        Column('image', String(255), nullable=False),
+        Column('last_run', DateTime),
+        Column('total_runtime', DOUBLE),
+        Column('latency', DOUBLE),
+        Column('accuracy', DOUBLE),
+        Column('timeliness', DOUBLE),
+        Column('tag', Text),
+        Column('benchmark_runtime', DOUBLE),
+        Column('received_at', DateTime),
+    ]
+
+
+def migration_3_results_history(connection):
+    '''Append-only history of every benchmark result, indexed for per-team
+    history pages and point-in-time rankings
+    '''
+    table = Table(RESULTS_TABLE, MetaData(), *results_columns())
+    table.create(connection, checkfirst=True)
+    create_indexes(connection, RESULTS_TABLE, [
+        Index('ix_results_image_last_run', table.c.image, table.c.last_run, table.c.id),
+        Index('ix_results_last_run', table.c.last_run, table.c.id),
+    ])
+
+
+def jobs_columns():
+    return [
+        Column('id', Integer, primary_key=True),
+        Column('image', String(255), nullable=False),
+        # queued, leased or done
+        Column('state', String(16), nullable=False),
+        Column('priority', Integer, nullable=False),
+        # The image was updated again while leased, it is queued again on completion
+        Column('pending', Boolean, nullable=False),
+        Column('enqueued_at', DateTime),
+        Column('attempts', Integer, nullable=False),
+        Column('lease_token', String(64)),
+        Column('leased_by', String(255)),
+        Column('lease_expires_at', DateTime),
+    ]
+
+
+def migration_4_job_queue(connection):
+    '''Benchmark job queue, one row per image, filled with the images currently marked as updated'''
+    table = Table(JOBS_TABLE, MetaData(), *jobs_columns())
+    table.create(connection, checkfirst=True)
+    create_indexes(connection, JOBS_TABLE, [
+        Index('ux_jobs_image', table.c.image, unique=True),
+        Index('ux_jobs_lease_token', table.c.lease_token, unique=True),
+        Index('ix_jobs_queue', table.c.state, table.c.priority, table.c.enqueued_at, table.c.id),
+        Index('ix_jobs_lease_expires_at', table.c.state, table.c.lease_expires_at),
+    ])
+    teams = Table(TEAMS_TABLE, MetaData(), *teams_columns())
+    now = datetime.datetime.utcnow()
+    queued = set(row[0] for row in connection.execute(select(table.c.image)))
+    rows = [dict(image=row.image, state='queued', priority=0, pending=False, enqueued_at=row.time_tag or now, attempts=0)
+            for row in connection.execute(teams.select().where(teams.c.updated == True, teams.c.image.isnot(None)))
+            if row.image not in queued]
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def migration_5_job_lease_start(connection):
+    '''Start time of the current lease, to estimate when running jobs finish'''
+    # Already added when a previous run failed before recording the version
+    if 'leased_at' in set(column['name'] for column in inspect(connection).get_columns(JOBS_TABLE)):
+        return
+    quote = connection.dialect.identifier_preparer.quote
+    target_type = DateTime().compile(dialect=connection.dialect)
+    connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (quote(JOBS_TABLE), quote('leased_at'), target_type)))
+
+
+# Ordered list of (version, migration). Never change a released migration, append a new one
+MIGRATIONS = [
+    (1, migration_1_typed_teams_table),
+    (2, migration_2_teams_indexes),
+    (3, migration_3_results_history),
+    (4, migration_4_job_queue),
+    (5, migration_5_job_lease_start),
+]
+
+
+@contextlib.contextmanager
+def migration_lock(connection):
+    if connection.dialect.name != 'mysql':
+        yield
+        return
+    acquired = connection.execute(text('SELECT GET_LOCK(:name, :timeout)'),
+                                  {'name': MIGRATION_LOCK_NAME, 'timeout': MIGRATION_LOCK_TIMEOUT_SECONDS}).scalar()
+    if not acquired:
+        raise RuntimeError('Timed out waiting for the schema migration lock!')
+    try:
+        yield
+    finally:
+        connection.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': MIGRATION_LOCK_NAME})
+
+
+def migrate(engine):
+    '''Bring the schema to the latest version. Applied versions are recorded in `schema_version`'''
+    with engine.connect() as lock_connection, migration_lock(lock_connection):
+        version_table = Table(SCHEMA_VERSION_TABLE, MetaData(), Column('version', Integer, nullable=False))
+        with engine.begin() as connection:
+            version_table.create(connection, checkfirst=True)
+            current = connection.execute(text('SELECT MAX(version) FROM %s' % SCHEMA_VERSION_TABLE)).scalar() or 0
+        for version, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            logging.info('Applying schema migration %d: %s', version, migration.__name__)
+            with engine.begin() as connection:
+                migration(connection)
+                connection.execute(version_table.insert().values(version=version))
+        return max(current, MIGRATIONS[-1][0])
@@ -0,0 +1,206 @@
+from bisect import bisect_left, insort
+
+# (column, descending, value used for NULL) of every ranked score,
+# mirroring the dense_rank() OVER (ORDER BY IFNULL(...)) definition of the scoreboard
+RANKED_COLUMNS = [
+    ('total_runtime', False, 1E10),
+    ('latency', False, 1E10),
+    ('timeliness', True, 0),
+    ('accuracy', True, 0),
+]
+# Running maxima kept for the queue ETA computation: (attribute, column)
+MAXIMUM_COLUMNS = [('max_last_run', 'last_run'), ('max_runtime', 'benchmark_runtime')]
+# Columns with a value -> team id lookup for the writes addressing a team by them
+LOOKUP_COLUMNS = ['image', 'name']
+# A change moving more than 1/RESORT_FRACTION of the teams re-sorts the whole order
+RESORT_FRACTION = 8
+
+
+class DenseRank:
+
+    def __init__(self, column, descending, default):
+        '''Dense rank of one score column: the rank of a team is the number
+        of distinct better values plus one
+        '''
+        self.column = column
+        self.rank_column = 'rank_' + column
+        self.descending = descending
+        self.default = default
+        self.keys = []  # sorted distinct keys, best first
+        self.members = {}  # key -> set of team ids
+
+    def key(self, row):
+        value = row.get(self.column)
+        value = self.default if value is None else float(value)
+        return -value if self.descending else value
+
+    def rank(self, key):
+        return bisect_left(self.keys, key) + 1
+
+    def load(self, keys):
+        '''Add the teams of the {team_id: key} dictionary at once, sorting the distinct keys once'''
+        for team_id, key in keys.items():
+            self.members.setdefault(key, set()).add(team_id)
+        self.keys = sorted(self.members)
+
+    def add(self, team_id, key):
+        '''Add a team, return the ids whose rank moved down because a new distinct value appeared'''
+        moved = []
+        if key not in self.members:
+            position = bisect_left(self.keys, key)
+            self.keys.insert(position, key)
+            self.members[key] = set()
+            moved = self.ids_after(position + 1)
+        self.members[key].add(team_id)
+        return moved
+
+    def remove(self, team_id, key):
+        '''Remove a team, return the ids whose rank moved up because a distinct value disappeared'''
+        members = self.members[key]
+        members.discard(team_id)
+        if members:
+            return []
+        position = bisect_left(self.keys, key)
+        del self.keys[position]
+        del self.members[key]
+        return self.ids_after(position)
+
+    def ids_after(self, position):
+        return [team_id for key in self.keys[position:] for team_id in self.members[key]]
+
+
+class RankingIndex:
+
+    def __init__(self, rows, engine=None):
+        '''In-memory ranking of the teams table, maintained incrementally on writes.
+        A write only recomputes the ranks of the teams it actually moved,
+        reads return a cached, already sorted result.
+        With a RankingEngine (non-default scoring), the rows are re-ranked by the engine
+        on the first read after a change instead.
+        '''
+        self.engine = engine
+        self.rows = {}  # id -> team row
+        self.lookup = {column: {} for column in LOOKUP_COLUMNS}  # column -> value -> id
+        self.keys = {}  # id -> [key per ranked column]
+        self.totals = {}  # id -> total rank
+        self.ranks = [DenseRank(*ranked_column) for ranked_column in RANKED_COLUMNS]
+        self.output = {}  # id -> ranked row, dropped when the row or its ranks change
+        self.result = None
+        self.max_last_run = None
+        self.max_runtime = None
+        # Loaded in bulk, the ranks moved by every single row are of no interest yet
+        for row in rows:
+            self.index_row(dict(row))
+        for position, rank in enumerate(self.ranks):
+            rank.load({team_id: keys[position] for team_id, keys in self.keys.items()})
+        for team_id in self.rows:
+            self.update_total(team_id)
+        self.order = sorted(self.sort_key(team_id) for team_id in self.rows)  # [(total rank, id)]
+        self.update_maxima()
+
+    def find(self, column, value):
+        return self.lookup[column].get(value)
+
+    def insert(self, row):
+        team_id = row['id']
+        moved = self.add_row(dict(row))
+        self.changed(moved + [team_id])
+        self.update_maxima({}, row)
+
+    def update(self, team_id, changes):
+        '''Apply the column changes to the team and move the ranks affected by them'''
+        row = self.rows.get(team_id)
+        if row is None:
+            return
+        old = {column: row.get(column) for _, column in MAXIMUM_COLUMNS}
+        self.index_lookup(team_id, remove=True)
+        row.update(changes)
+        self.index_lookup(team_id)
+        moved = [team_id]
+        keys = self.keys[team_id]
+        for position, rank in enumerate(self.ranks):
+            key = rank.key(row)
+            if key != keys[position]:
+                moved += rank.remove(team_id, keys[position])
+                moved += rank.add(team_id, key)
+                keys[position] = key
+        self.changed(moved)
+        self.update_maxima(old, row)
+
+    def ranked(self):
+        '''Return (rows sorted by total rank, last experiment time, maximum benchmark runtime)'''
+        if self.result is None and self.engine is not None:
+            self.result = (self.engine.rank(self.rows.values()), self.max_last_run or "", self.max_runtime or 0)
+        if self.result is None:
+            rows = []
+            for _, team_id in self.order:
+                if team_id not in self.output:
+                    output = dict(self.rows[team_id])
+                    for position, rank in enumerate(self.ranks):
+                        output[rank.rank_column] = rank.rank(self.keys[team_id][position])
+                    output['total_rank'] = self.totals[team_id]
+                    self.output[team_id] = output
+                rows.append(self.output[team_id])
+            self.result = (rows, self.max_last_run or "", self.max_runtime or 0)
+        return self.result
+
+    def index_row(self, row):
+        team_id = row['id']
+        self.rows[team_id] = row
+        self.index_lookup(team_id)
+        self.keys[team_id] = [rank.key(row) for rank in self.ranks]
+        return team_id
+
+    def add_row(self, row):
+        team_id = self.index_row(row)
+        moved = []
+        for position, rank in enumerate(self.ranks):
+            moved += rank.add(team_id, self.keys[team_id][position])
+        return moved
+
+    def index_lookup(self, team_id, remove=False):
+        row = self.rows[team_id]
+        for column, lookup in self.lookup.items():
+            value = row.get(column)
+            if value is None:
+                continue
+            if not remove:
+                lookup[value] = team_id
+            elif lookup.get(value) == team_id:
+                del lookup[value]
+
+    def update_total(self, team_id):
+        self.totals[team_id] = sum(rank.rank(key) for rank, key in zip(self.ranks, self.keys[team_id]))
+
+    def changed(self, moved):
+        '''Recompute the total rank of the moved teams and move them to their new place in the order'''
+        moved = set(moved)
+        resort = len(moved) * RESORT_FRACTION > len(self.order)
+        for team_id in moved:
+            if not resort and team_id in self.totals:
+                del self.order[bisect_left(self.order, self.sort_key(team_id))]
+            self.update_total(team_id)
+            self.output.pop(team_id, None)
+            if not resort:
+                insort(self.order, self.sort_key(team_id))
+        if resort:
+            self.order = sorted(self.sort_key(team_id) for team_id in self.rows)
+        self.result = None
+
+    def update_maxima(self, old=None, new=None):
+        '''Keep the running maxima up to date after a team changed from `old` to `new`.
+        All teams are only rescanned when the team holding a maximum decreased it.
+        '''
+        for attribute, column in MAXIMUM_COLUMNS:
+            current = getattr(self, attribute)
+            old_value = old.get(column) if old is not None else None
+            new_value = new.get(column) if new is not None else None
+            if new is None or (old_value is not None and old_value == current and (new_value is None or new_value < current)):
+                values = [row[column] for row in self.rows.values() if row.get(column) is not None]
+                setattr(self, attribute, max(values) if values else None)
+            elif new_value is not None and (current is None or new_value > current):
+                setattr(self, attribute, new_value)
+        self.result = None
+
+    def sort_key(self, team_id):
+        return (self.totals[team_id], team_id)
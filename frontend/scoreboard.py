@@ -0,0 +1,71 @@
+import os
+import gzip
+import json
+import hashlib
+import datetime
+import threading
+from flask import Response
+
+# Keep a gzip-compressed copy of every snapshot for clients accepting it
+SCOREBOARD_GZIP = os.getenv("SCOREBOARD_GZIP", default="1") not in ('0', 'false', 'False')
+
+
+class Snapshot:
+
+    def __init__(self, body, mimetype):
+        '''Immutable pre-rendered response body with its strong validator'''
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.gzipped = gzip.compress(self.body) if SCOREBOARD_GZIP else None
+
+    def to_response(self, request):
+        '''Serve the snapshot, answering 304 if the client already has this version'''
+        use_gzip = self.gzipped is not None and 'gzip' in request.headers.get('Accept-Encoding', '')
+        # Each encoding is a different representation and gets its own strong ETag
+        etag = self.etag + '-gz' if use_gzip else self.etag
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.gzipped if use_gzip else self.body, mimetype=self.mimetype)
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+
+class SnapshotCache:
+
+    def __init__(self):
+        '''Versioned snapshots of the public scoreboard.
+        They are rebuilt only when the ranking or the versions of the job queue and team statuses they were built from change.
+        '''
+        self.lock = threading.Lock()
+        self.ranking = None
+        self.version = None
+        self.snapshots = {}
+        self.builds = 0
+
+    def get(self, name, ranking, version, build):
+        '''Return the snapshot `name`, calling `build()` -> Snapshot if the inputs changed.
+        `ranking` is the cached ranking object, compared by identity, `version` is compared by value
+        '''
+        with self.lock:
+            if self.ranking is not ranking or self.version != version:
+                self.ranking = ranking
+                self.version = version
+                self.snapshots = {}
+            snapshot = self.snapshots.get(name)
+        if snapshot is None:
+            snapshot = build()
+            with self.lock:
+                if self.ranking is ranking and self.version == version:
+                    self.snapshots[name] = snapshot
+                self.builds += 1
+        return snapshot
+
+
+def to_json(data):
+    return json.dumps(data, default=lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else str(obj))
@@ -1,29 +1,124 @@
 from database_access_object import Teams, connect_to_db
 from werkzeug.security import safe_str_cmp
-import subprocess
-import json
+import collections
+import threading
+import logging
+import socket
+import time
+import os
 
-REGISTRATIONS = connect_to_db("teams")['registrations']
+# Bound on how long a change of the registrations table made without bumping
+# 'registrations_version' (e.g. a manual DELETE) can go unnoticed
+IDENTITY_CACHE_TTL_SECONDS = int(os.getenv("IDENTITY_CACHE_TTL_SECONDS", default=300))
+IDENTITY_CACHE_SIZE = 256
+# How long the address of an allowed host name is trusted before it is resolved again
+ALLOWED_HOSTS_TTL_SECONDS = int(os.getenv("ALLOWED_HOSTS_TTL_SECONDS", default=60))
+
+
+class TTLCache:
+
+    def __init__(self, size, ttl, clock=time.time):
+        '''Thread-safe LRU cache whose entries also expire `ttl` seconds after being stored'''
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (value, expires at)
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, load, version=None):
+        '''Return the cached value of `key`, calling `load()` on a miss.
+        All entries are dropped when `version` differs from the one they were stored with.
+        '''
+        with self.lock:
+            self.check_version(version)
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value = load()
+        self.put(key, value, version=version)
+        return value
+
+    def put(self, key, value, ttl=None, version=None):
+        with self.lock:
+            self.check_version(version)
+            ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+            self.entries[key] = (value, self.clock() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def check_version(self, version):
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'invalidations': self.invalidations}
+
+
+# username -> registration row (None for unknown users)
+IDENTITIES = TTLCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL_SECONDS)
+
+
+def registrations():
+    '''The registrations table, looked up on first use so that importing this module needs no DB'''
+    return connect_to_db("teams")['registrations']
 
 
 def authenticate(username, password):
-    user = REGISTRATIONS.find_one(username=username)
+    # Logins always check the DB, and drop the cached identity so that it is reloaded
+    IDENTITIES.invalidate(username)
+    user = registrations().find_one(username=username)
     if user and safe_str_cmp(user['password'].encode('utf-8'), password.encode('utf-8')):
         return user
 
 
-def identity(payload):
-    user_id = payload['identity']
-    return REGISTRATIONS.find_one(username=user_id)
+def identity(payload, version=None):
+    '''Return the registration of the token's user, cached for IDENTITY_CACHE_TTL_SECONDS
+    or until `version` (the shared 'registrations_version') changes
+    '''
+    # Older flask_jwt_extended releases store the identity in the 'identity' claim
+    user_id = payload.get('identity', payload.get('sub'))
+    return IDENTITIES.get(user_id, lambda: registrations().find_one(username=user_id), version)
+
+
+class AllowedHosts:
 
+    def __init__(self, names, ttl=ALLOWED_HOSTS_TTL_SECONDS):
+        '''Addresses of the given host names or IP addresses, resolved through DNS on first use
+        and again after `ttl` seconds, so that restarted containers are recognized by their new address.
+        Names that do not resolve (yet) allow nothing and are retried on the next check.
+        '''
+        self.names = [name for name in names if name]
+        self.addresses = TTLCache(max(len(self.names), 1), ttl)
 
-def restart_scheduler(container_name):
-    subprocess.check_output(['docker', 'restart', container_name])
+    def __contains__(self, address):
+        return address in self.resolve()
 
+    def __repr__(self):
+        return 'AllowedHosts(%s)' % ', '.join(self.names)
 
-def find_container_ip_addr(container_name):
-    info = subprocess.check_output(['docker', 'inspect', container_name])
-    # parsing nested json from docker inspect
-    ip = list(json.loads(info.decode('utf-8'))[0]["NetworkSettings"]["Networks"].values())[0]["IPAddress"]
-    print("%s container ip is: %s", container_name, ip)
-    return ip
+    def resolve(self):
+        addresses = set()
+        for name in self.names:
+            try:
+                addresses.add(self.addresses.get(name, lambda: socket.gethostbyname(name)))
+            except OSError as e:
+                logging.warning('Could not resolve allowed host %s: %s', name, e)
+        return addresses
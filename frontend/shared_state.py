@@ -0,0 +1,143 @@
+import os
+import json
+import sqlite3
+import threading
+
+# Backend holding the state shared by all controller workers: memory, sqlite or redis
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", default="sqlite")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", default="frontend_state.db")
+SHARED_STATE_REDIS_URL = os.getenv("SHARED_STATE_REDIS_URL", default="redis://localhost:6379/0")
+SHARED_STATE_PREFIX = 'controller:'
+
+
+class LocalStateStore:
+
+    def __init__(self):
+        '''State kept in process memory. Only consistent with a single worker process'''
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.values.get(key, default)
+
+    def get_many(self, keys):
+        with self.lock:
+            return {key: self.values.get(key) for key in keys}
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def update(self, key, function, default=None):
+        '''Atomically replace the value of `key` with function(value) and return it'''
+        with self.lock:
+            value = function(self.values.get(key, default))
+            self.values[key] = value
+            return value
+
+    def incr(self, key):
+        return self.update(key, lambda value: value + 1, 0)
+
+
+class SQLiteStateStore:
+
+    def __init__(self, path):
+        '''State kept in a local SQLite file, shared by all worker processes on the host.
+        Values are stored as JSON, updates run in an immediate (write-locked) transaction.
+        '''
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def get(self, key, default=None):
+        row = self.connection().execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_many(self, keys):
+        placeholders = ', '.join('?' for _ in keys)
+        rows = self.connection().execute('SELECT key, value FROM state WHERE key IN (%s)' % placeholders, list(keys))
+        values = {key: None for key in keys}
+        values.update({key: json.loads(value) for key, value in rows})
+        return values
+
+    def set(self, key, value):
+        self.connection().execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def update(self, key, function, default=None):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+            value = function(json.loads(row[0]) if row else default)
+            connection.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+            connection.execute('COMMIT')
+            return value
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+    def incr(self, key):
+        return self.update(key, lambda value: value + 1, 0)
+
+
+class RedisStateStore:
+
+    def __init__(self, client, prefix=SHARED_STATE_PREFIX):
+        '''State kept in Redis, shared across hosts. Works with any client exposing the
+        redis-py interface, so a local stand-in can replace the server.
+        '''
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else default
+
+    def get_many(self, keys):
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: json.loads(value) if value is not None else None for key, value in zip(keys, values)}
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value))
+
+    def update(self, key, function, default=None):
+        '''Optimistic read-modify-write, retried when another worker changed the key meanwhile'''
+        import redis
+        name = self.prefix + key
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    current = pipe.get(name)
+                    value = function(json.loads(current) if current is not None else default)
+                    pipe.multi()
+                    pipe.set(name, json.dumps(value))
+                    pipe.execute()
+                    return value
+                except redis.WatchError:
+                    continue
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+
+def create_state_store(backend=SHARED_STATE_BACKEND):
+    if backend == 'memory':
+        return LocalStateStore()
+    if backend == 'sqlite':
+        return SQLiteStateStore(SHARED_STATE_PATH)
+    if backend == 'redis':
+        import redis
+        return RedisStateStore(redis.Redis.from_url(SHARED_STATE_REDIS_URL))
+    raise ValueError('Unknown SHARED_STATE_BACKEND "%s"!' % backend)
@@ -1,5 +1,8 @@
-from controller import app
+from controller import app, TEAMS_DAO, JOBS, SCOREBOARD
+from migrations import RESULTS_TABLE
 import unittest
+import time
+import gzip
 import json
 from flask import jsonify
 import datetime
@@ -43,6 +46,196 @@ class TestMyAPI(unittest.TestCase):
                 self.assertEqual(v, 'updated' or 'old')
 
 
+# Requests from the scheduler and manager network
+MANAGER_ENVIRON = {'REMOTE_ADDR': '172.17.0.2'}
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        TEAMS_DAO.add_team('test-jobs-team', 'test-jobs/image', True)
+        # Ahead of any other queued job
+        JOBS.enqueue(['test-jobs/image'], priority=100)
+
+    def queue(self, c):
+        response = c.get('/scoreboard.json')
+        self.assertEqual(response.status_code, 200)
+        return {name: entry for item in json.loads(response.data)['queue'] for name, entry in item.items()}
+
+    def test_completed_job_leaves_the_scoreboard_queue(self):
+        with app.test_client() as c:
+            self.assertIn('test-jobs-team', self.queue(c))
+            response = c.post('/jobs/lease', json={'worker': 'test-manager'}, environ_base=MANAGER_ENVIRON)
+            job, = json.loads(response.data)['jobs']
+            self.assertEqual(job['image'], 'test-jobs/image')
+            self.assertEqual(self.queue(c)['test-jobs-team']['status'], 'running')
+            response = c.post('/jobs/complete', json={'lease': job['lease']}, environ_base=MANAGER_ENVIRON)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('test-jobs-team', self.queue(c))
+            response = c.post('/jobs/complete', json={'lease': job['lease']}, environ_base=MANAGER_ENVIRON)
+            self.assertEqual(response.status_code, 409)
+
+    def test_expired_lease_is_reclaimed_by_the_next_lease(self):
+        with app.test_client() as c:
+            lease_seconds = JOBS.lease_seconds
+            JOBS.lease_seconds = 0
+            try:
+                response = c.post('/jobs/lease', json={'worker': 'lost-manager'}, environ_base=MANAGER_ENVIRON)
+            finally:
+                JOBS.lease_seconds = lease_seconds
+            lost, = json.loads(response.data)['jobs']
+            self.assertEqual(lost['image'], 'test-jobs/image')
+            response = c.post('/jobs/lease', json={'worker': 'test-manager'}, environ_base=MANAGER_ENVIRON)
+            job, = json.loads(response.data)['jobs']
+            self.assertEqual(job['image'], 'test-jobs/image')
+            self.assertNotEqual(job['lease'], lost['lease'])
+            self.assertEqual(self.queue(c)['test-jobs-team']['status'], 'running')
+            response = c.post('/jobs/complete', json={'lease': lost['lease']}, environ_base=MANAGER_ENVIRON)
+            self.assertEqual(response.status_code, 409)
+            response = c.post('/jobs/complete', json={'lease': job['lease']}, environ_base=MANAGER_ENVIRON)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('test-jobs-team', self.queue(c))
+
+    def test_unchanged_queue_keeps_the_etag(self):
+        with app.test_client() as c:
+            first = c.get('/scoreboard.json')
+            builds = SCOREBOARD.builds
+            time.sleep(1)
+            second = c.get('/scoreboard.json')
+            self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+            self.assertEqual(second.data, first.data)
+            self.assertEqual(SCOREBOARD.builds, builds)
+            self.assertIn('test-jobs-team', self.queue(c))
+
+
+def result(image, tag, last_run, total_runtime=10.0):
+    return {'image': image, 'total_runtime': total_runtime, 'latency': 2.0, 'accuracy': 0.9, 'timeliness': 0.8,
+            'tag': tag, 'last_run': last_run, 'benchmark_runtime': 120}
+
+
+class TestResults(unittest.TestCase):
+    def setUp(self):
+        for name in ['a', 'b', 'unknown']:
+            TEAMS_DAO.db[RESULTS_TABLE].delete(image='test-results/' + name)
+        TEAMS_DAO.add_team('test-results-a', 'test-results/a', True)
+        TEAMS_DAO.add_team('test-results-b', 'test-results/b', True)
+
+    def history(self, image):
+        return [(row['tag'], row['total_runtime']) for row in TEAMS_DAO.get_history(image, 10)]
+
+    def test_batch_of_results(self):
+        results = [result('test-results/a', 'v1', '2020-05-01T10:00:00'),
+                   result('test-results/b', 'v1', '2020-05-01T10:30:00', 20.0),
+                   # The latest result of an image in the batch wins
+                   result('test-results/a', 'v2', '2020-05-01T11:00:00', 5.0),
+                   result('test-results/unknown', 'v1', '2020-05-01T11:30:00')]
+        with app.test_client() as c:
+            response = c.post('/result', json=results, environ_base=MANAGER_ENVIRON)
+            self.assertEqual(response.status_code, 200)
+        columns = ['tag', 'last_run', 'total_runtime', 'benchmark_runtime', 'updated']
+        self.assertEqual(TEAMS_DAO.get_team_data('test-results/a', columns), {
+            'tag': 'v2', 'last_run': datetime.datetime(2020, 5, 1, 11), 'total_runtime': 5.0,
+            'benchmark_runtime': 120, 'updated': False})
+        self.assertEqual(TEAMS_DAO.get_team_data('test-results/b', columns), {
+            'tag': 'v1', 'last_run': datetime.datetime(2020, 5, 1, 10, 30), 'total_runtime': 20.0,
+            'benchmark_runtime': 120, 'updated': False})
+        self.assertEqual(TEAMS_DAO.get_team_data('test-results/unknown', columns), {})
+        # Every result is kept in the history, in the order of the runs
+        self.assertEqual(self.history('test-results/a'), [('v1', 10.0), ('v2', 5.0)])
+        self.assertEqual(self.history('test-results/b'), [('v1', 20.0)])
+        self.assertEqual(self.history('test-results/unknown'), [('v1', 10.0)])
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        for name in ['a', 'b']:
+            TEAMS_DAO.db[RESULTS_TABLE].delete(image='test-history/' + name)
+            TEAMS_DAO.add_team('test-history-' + name, 'test-history/' + name, False)
+        # Two runs of `a` at 11:00, a page boundary falls between them
+        results = [result('test-history/a', 'a%d' % run, '2020-06-01T%02d:00:00' % hour)
+                   for run, hour in enumerate([10, 11, 11, 13, 14])]
+        results += [result('test-history/b', 'b0', '2020-06-01T11:00:00'), result('test-history/b', 'b1', '2020-06-01T13:00:00')]
+        with app.test_client() as c:
+            self.assertEqual(c.post('/result', json=results, environ_base=MANAGER_ENVIRON).status_code, 200)
+
+    def pages(self, c, limit):
+        '''Follow the cursors of the history of `a`, return the tags of every page'''
+        pages = []
+        query = {'limit': limit}
+        while True:
+            response = c.get('/history/test-history/a', query_string=query)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.data)
+            pages.append([row['tag'] for row in page['results']])
+            if page['next'] is None:
+                return pages
+            query = {'limit': limit, 'cursor': page['next']}
+
+    def test_history_pages(self):
+        with app.test_client() as c:
+            self.assertEqual(self.pages(c, 2), [['a0', 'a1'], ['a2', 'a3'], ['a4']])
+            # A full last page is followed by an empty one
+            self.assertEqual(self.pages(c, 5), [['a0', 'a1', 'a2', 'a3', 'a4'], []])
+            self.assertEqual(self.pages(c, 100), [['a0', 'a1', 'a2', 'a3', 'a4']])
+            for cursor in ['bogus', 'not-a-time_1', '2020-06-01T11:00:00.000000_x']:
+                response = c.get('/history/test-history/a', query_string={'cursor': cursor})
+                self.assertEqual(response.status_code, 400)
+
+    def test_ranking_at_a_past_time(self):
+        with app.test_client() as c:
+            def ranking(at):
+                response = c.get('/ranking', query_string={'at': at})
+                self.assertEqual(response.status_code, 200)
+                return {row['name']: row['tag'] for row in json.loads(response.data)['ranking']
+                        if row['name'].startswith('test-history')}
+            self.assertEqual(ranking('2020-06-01T10:30:00'), {'test-history-a': 'a0'})
+            self.assertEqual(ranking('2020-06-01T12:30:00'), {'test-history-a': 'a2', 'test-history-b': 'b0'})
+            self.assertEqual(ranking('2020-06-02T00:00:00'), {'test-history-a': 'a4', 'test-history-b': 'b1'})
+            self.assertEqual(c.get('/ranking', query_string={'at': 'yesterday'}).status_code, 400)
+
+    def test_history_export(self):
+        with app.test_client() as c:
+            response = c.get('/history', environ_base=MANAGER_ENVIRON)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            rows = [row for row in json.loads(response.data) if row['image'].startswith('test-history')]
+            self.assertEqual([row['tag'] for row in rows], ['a0', 'a1', 'a2', 'a3', 'a4', 'b0', 'b1'])
+            self.assertEqual([row['id'] for row in rows], sorted(row['id'] for row in rows))
+            response = c.get('/history', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+            self.assertEqual(response.status_code, 403)
+
+
+class TestScoreboardSnapshot(unittest.TestCase):
+    def test_unchanged_scoreboard_is_not_sent_again(self):
+        with app.test_client() as c:
+            for path in ['/scoreboard.json', '/']:
+                response = c.get(path)
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers['ETag']
+                response = c.get(path, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.data, b'')
+                self.assertEqual(response.headers['ETag'], etag)
+                response = c.get(path, headers={'If-None-Match': '"other"'})
+                self.assertEqual(response.status_code, 200)
+
+    def test_compressed_scoreboard(self):
+        with app.test_client() as c:
+            plain = c.get('/scoreboard.json')
+            self.assertNotIn('Content-Encoding', plain.headers)
+            self.assertIn('Accept-Encoding', plain.headers['Vary'])
+            response = c.get('/scoreboard.json', headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(gzip.decompress(response.data), plain.data)
+            # Each encoding has its own validator
+            self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+            response = c.get('/scoreboard.json', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+            response = c.get('/scoreboard.json', headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 200)
+
+
 def main():
     unittest.main()
 
@@ -0,0 +1,67 @@
+from eta import RuntimeEstimator
+import unittest
+import datetime
+
+NOW = datetime.datetime(2020, 5, 1, 12, 0, 0)
+
+
+def minutes(value):
+    return datetime.timedelta(minutes=value)
+
+
+def result(result_id, image, seconds, received_at=NOW):
+    return {'id': result_id, 'image': image, 'benchmark_runtime': seconds, 'received_at': received_at}
+
+
+def job(image, state='queued', leased_by=None, leased_at=None, enqueued_at=NOW - datetime.timedelta(hours=1)):
+    return {'image': image, 'state': state, 'leased_by': leased_by, 'leased_at': leased_at, 'enqueued_at': enqueued_at}
+
+
+class TestRuntimeEstimator(unittest.TestCase):
+    def setUp(self):
+        self.estimator = RuntimeEstimator(alpha=0.5)
+
+    def test_moving_average_per_image(self):
+        self.estimator.catch_up([result(1, 'a/a', 600), result(2, 'a/a', 1200), result(3, 'b/b', 60)])
+        self.assertEqual(self.estimator.estimate('a/a', 10), 900)
+        self.assertEqual(self.estimator.estimate('b/b', 10), 60)
+        # Images that never ran get the moving average of all runs
+        self.assertEqual(self.estimator.estimate('c/c', 10), 480)
+        self.assertEqual(RuntimeEstimator().estimate('c/c', 10), 10)
+
+    def test_rows_are_applied_once(self):
+        self.estimator.catch_up([result(1, 'a/a', 600), result(2, 'a/a', 1200)])
+        self.estimator.catch_up([result(2, 'a/a', 1200), result(3, 'a/a', 300)])
+        self.assertEqual(self.estimator.estimate('a/a', 10), 600)
+        self.assertEqual(self.estimator.last_id, 3)
+
+    def test_forecast_with_one_manager(self):
+        self.estimator.catch_up([result(1, 'a/a', 600), result(2, 'b/b', 300), result(3, 'c/c', 120)])
+        jobs = [job('a/a', 'leased', 'manager', NOW - minutes(4)), job('b/b'), job('c/c')]
+        self.assertEqual(self.estimator.forecast(jobs, 60),
+                         [('a/a', NOW + minutes(6)), ('b/b', NOW + minutes(11)), ('c/c', NOW + minutes(13))])
+
+    def test_forecast_runs_queued_jobs_on_every_manager(self):
+        self.estimator.catch_up([result(1, 'a/a', 600), result(2, 'b/b', 600), result(3, 'c/c', 600), result(4, 'd/d', 600)])
+        jobs = [job('a/a', 'leased', 'manager-1', NOW), job('b/b', 'leased', 'manager-2', NOW - minutes(5)),
+                job('c/c'), job('d/d')]
+        etas = dict(self.estimator.forecast(jobs, 60))
+        self.assertEqual(etas['c/c'], NOW + minutes(15))
+        self.assertEqual(etas['d/d'], NOW + minutes(20))
+        # An overdue run keeps the ETA of its lease
+        self.assertEqual(self.estimator.forecast([job('a/a', 'leased', 'manager-1', NOW - minutes(30))], 60),
+                         [('a/a', NOW - minutes(20))])
+
+    def test_forecast_without_leases_starts_after_the_last_result(self):
+        self.estimator.catch_up([result(1, 'a/a', 600), result(2, 'b/b', 300, NOW - minutes(5))])
+        jobs = [job('a/a'), job('b/b', enqueued_at=NOW + minutes(30))]
+        # A job does not start before it was queued
+        self.assertEqual(self.estimator.forecast(jobs, 60), [('a/a', NOW + minutes(10)), ('b/b', NOW + minutes(35))])
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+from job_queue import JobQueue
+from migrations import migrate
+from shared_state import LocalStateStore
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+import datetime
+import tempfile
+import dataset
+import os
+
+
+class Clock:
+    def __init__(self):
+        self.now = datetime.datetime(2020, 5, 1, 12, 0, 0)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = dataset.connect('sqlite:///' + os.path.join(self.directory.name, 'teams.db'))
+        migrate(self.db.engine)
+        self.clock = Clock()
+        self.state = LocalStateStore()
+        self.queue = JobQueue(self.db, lease_seconds=60, clock=self.clock, state=self.state)
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def enqueue(self, *images):
+        self.queue.enqueue(images)
+        self.clock.advance(1)
+
+    def test_fifo_and_priority(self):
+        self.enqueue('a/a', 'b/b')
+        self.enqueue('c/c')
+        self.queue.enqueue(['d/d'], priority=1)
+        self.enqueue('a/a')  # Already queued, keeps its place
+        self.assertEqual([job['image'] for job in self.queue.lease('manager', count=10)], ['d/d', 'a/a', 'b/b', 'c/c'])
+        self.assertEqual(self.queue.lease('manager'), [])
+
+    def test_expired_lease_is_queued_again(self):
+        self.enqueue('a/a', 'b/b')
+        first, = self.queue.lease('manager-1')
+        self.clock.advance(50)
+        self.assertIsNotNone(self.queue.heartbeat(first['lease']))
+        self.clock.advance(50)
+        second, = self.queue.lease('manager-2')
+        self.assertEqual(second['image'], 'b/b')
+        self.clock.advance(20)
+        # The first lease expired, its image goes to another manager and the late completion is rejected
+        self.assertEqual(self.queue.requeue_expired(), ['a/a'])
+        third, = self.queue.lease('manager-2')
+        self.assertEqual(third['image'], 'a/a')
+        self.assertFalse(self.queue.complete(first['lease']))
+        self.assertTrue(self.queue.complete(third['lease']))
+        self.assertEqual([job['image'] for job in self.queue.jobs()], ['b/b'])
+
+    def test_expired_leases_are_queued_again_on_request(self):
+        self.enqueue('a/a', 'b/b')
+        first, second = self.queue.lease('manager', count=2)
+        self.clock.advance(30)
+        self.queue.heartbeat(second['lease'])
+        self.clock.advance(31)
+        self.assertEqual(self.queue.requeue_expired(), ['a/a'])
+        self.assertEqual([(job['image'], job['state']) for job in self.queue.jobs()], [('b/b', 'leased'), ('a/a', 'queued')])
+        self.assertEqual(self.queue.complete(second['lease']), 'b/b')
+
+    def test_update_during_run_is_queued_again(self):
+        self.enqueue('a/a')
+        job, = self.queue.lease('manager')
+        self.enqueue('a/a')
+        self.assertEqual(self.queue.lease('manager'), [])
+        self.assertTrue(self.queue.complete(job['lease']))
+        self.assertEqual([job['image'] for job in self.queue.lease('manager')], ['a/a'])
+
+    def test_mirror_follows_the_writes_of_all_workers(self):
+        other = JobQueue(self.db, lease_seconds=60, clock=self.clock, state=self.state)
+        self.enqueue('a/a', 'b/b', 'c/c')
+        self.assertEqual(self.queue.snapshot(), (self.queue.jobs(), True))
+        self.assertEqual(other.snapshot()[1], True)
+        first, = self.queue.lease('manager')
+        self.queue.settle(['c/c'])
+        # Applied to the mirror of the writer, reloaded by the other worker
+        self.assertEqual(self.queue.snapshot(), (self.queue.jobs(), False))
+        self.assertEqual(other.snapshot(), (self.queue.jobs(), True))
+        self.assertEqual(other.snapshot()[1], False)
+        other.complete(first['lease'])
+        self.assertEqual([job['image'] for job in self.queue.snapshot()[0]], ['b/b'])
+
+    def test_concurrent_leases_do_not_overlap(self):
+        images = ['team%d/image' % team for team in range(40)]
+        self.queue.enqueue(images)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            batches = list(executor.map(lambda worker: [job['image'] for _ in range(20) for job in self.queue.lease(worker)],
+                                        ['manager-%d' % worker for worker in range(4)]))
+        leased = [image for batch in batches for image in batch]
+        self.assertEqual(sorted(leased), sorted(images))
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
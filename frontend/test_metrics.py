@@ -0,0 +1,64 @@
+from metrics import Registry, timed
+from database_access_object import create_database, DB_QUERY_ERRORS
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter('requests_total', 'Requests', ['route'])
+        gauge = self.registry.gauge('in_flight', 'In flight')
+        counter.inc(route='/')
+        counter.inc(2, route='/')
+        counter.inc(route='/a"b')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{route="/"} 3',
+            'requests_total{route="/a\\"b"} 1',
+            '# HELP in_flight In flight',
+            '# TYPE in_flight gauge',
+            'in_flight 1',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency', ['route'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, route='/')
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'latency_seconds_bucket{route="/",le="0.1"} 2',
+            'latency_seconds_bucket{route="/",le="1.0"} 3',
+            'latency_seconds_bucket{route="/",le="+Inf"} 4',
+            'latency_seconds_sum{route="/"} 3.65',
+            'latency_seconds_count{route="/"} 4',
+        ])
+
+    def test_timed_decorator(self):
+        histogram = self.registry.histogram('operation_seconds', 'Operations', ['operation'])
+        function = timed(histogram, operation='add')(lambda a, b: a + b)
+        self.assertEqual(function(1, 2), 3)
+        self.assertIn('operation_seconds_count{operation="add"} 1', self.registry.render())
+
+    def test_failed_queries_are_counted(self):
+        db = create_database('sqlite:///:memory:')
+        errors = DB_QUERY_ERRORS.values.get((), 0)
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+            with self.assertRaises(OperationalError):
+                connection.execute(text('SELECT * FROM missing'))
+            self.assertEqual(connection.info['query_start'], [])
+        self.assertEqual(DB_QUERY_ERRORS.values[()], errors + 1)
+
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+from migrations import migrate, MIGRATIONS
+from sqlalchemy import create_engine, inspect, text
+import unittest
+import tempfile
+import os
+
+# The teams table as dataset created it implicitly, before the columns were typed
+LEGACY_TEAMS_TABLE = '''CREATE TABLE teams (id INTEGER PRIMARY KEY, name TEXT, image TEXT, updated TEXT, time_tag TEXT,
+    total_runtime FLOAT, latency FLOAT, accuracy FLOAT, timeliness FLOAT, tag TEXT, last_run TEXT, benchmark_runtime FLOAT)'''
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.directory.name, 'teams.db'))
+        with self.engine.begin() as connection:
+            connection.execute(text(LEGACY_TEAMS_TABLE))
+            connection.execute(text("INSERT INTO teams (id, name, image, updated, last_run) VALUES "
+                                    "(1, 'a', 'a/a', 'True', '2020-05-01T10:00:00'), (2, 'b', 'b/b', 'False', NULL)"))
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def execute(self, *statements):
+        with self.engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+
+    def columns(self, table):
+        return {column['name']: str(column['type']) for column in inspect(self.engine).get_columns(table)}
+
+    def indexes(self, table):
+        return set(index['name'] for index in inspect(self.engine).get_indexes(table))
+
+    def test_half_applied_migrations_are_resumed(self):
+        # Left behind by a conversion that failed after dropping `updated`, and by one that failed
+        # after adding the copy of `last_run`. Migration 3 failed after creating one of its indexes
+        self.execute('ALTER TABLE teams ADD COLUMN updated_migrated BOOLEAN',
+                     'UPDATE teams SET updated_migrated = (updated = \'True\')',
+                     'ALTER TABLE teams DROP COLUMN updated',
+                     'ALTER TABLE teams ADD COLUMN last_run_migrated DATETIME',
+                     'CREATE TABLE results (id INTEGER PRIMARY KEY, image VARCHAR(255) NOT NULL, last_run DATETIME, '
+                     'total_runtime FLOAT, latency FLOAT, accuracy FLOAT, timeliness FLOAT, tag TEXT, '
+                     'benchmark_runtime FLOAT, received_at DATETIME)',
+                     'CREATE INDEX ix_results_last_run ON results (last_run, id)')
+        self.assertEqual(migrate(self.engine), MIGRATIONS[-1][0])
+        columns = self.columns('teams')
+        self.assertEqual((columns['updated'], columns['last_run']), ('BOOLEAN', 'DATETIME'))
+        self.assertFalse([column for column in columns if column.endswith('_migrated')])
+        self.assertEqual(self.indexes('results'), {'ix_results_image_last_run', 'ix_results_last_run'})
+        with self.engine.connect() as connection:
+            rows = list(connection.execute(text('SELECT image, updated, last_run FROM teams ORDER BY id')))
+        self.assertEqual([tuple(row) for row in rows], [('a/a', 1, '2020-05-01 10:00:00'), ('b/b', 0, None)])
+        # The updated image was queued once
+        with self.engine.connect() as connection:
+            self.assertEqual(list(connection.execute(text('SELECT image FROM jobs'))), [('a/a',)])
+        self.assertEqual(self.columns('jobs')['leased_at'], 'DATETIME')
+
+    def test_released_migrations_are_frozen(self):
+        # Columns added by a later migration are not created by an earlier one
+        with self.engine.begin() as connection:
+            for version, migration in MIGRATIONS[:4]:
+                migration(connection)
+        self.assertNotIn('leased_at', self.columns('jobs'))
+        with self.engine.begin() as connection:
+            MIGRATIONS[4][1](connection)
+        self.assertIn('leased_at', self.columns('jobs'))
+
+    def test_duplicate_teams_are_reported_before_indexing(self):
+        self.execute("INSERT INTO teams (id, name, image) VALUES (3, 'a', 'c/c')")
+        with self.assertRaisesRegex(RuntimeError, 'duplicate name'):
+            migrate(self.engine)
+        self.assertFalse(self.indexes('teams'))
+        self.execute("UPDATE teams SET name = 'c' WHERE id = 3")
+        self.assertEqual(migrate(self.engine), MIGRATIONS[-1][0])
+        self.assertIn('ux_teams_name', self.indexes('teams'))
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+from ranking import RankingIndex
+import unittest
+import sqlite3
+import random
+
+# The SQL definition of the scoreboard ranking that RankingIndex maintains incrementally
+RANKING_QUERY = '''SELECT T.id, (R.rank_total_runtime+R.rank_latency+R.rank_timeliness+R.rank_accuracy) as total_rank FROM
+    teams AS T INNER JOIN
+        (SELECT id,
+        dense_rank() OVER (ORDER BY IFNULL(total_runtime, 1E10) ASC) AS rank_total_runtime,
+        dense_rank() OVER (ORDER BY IFNULL(latency, 1E10) ASC) AS rank_latency,
+        dense_rank() OVER (ORDER BY IFNULL(timeliness, 0) DESC) AS rank_timeliness,
+        dense_rank() OVER (ORDER BY IFNULL(accuracy, 0) DESC) AS rank_accuracy
+        FROM teams) AS R
+        ON T.id = R.id
+    ORDER BY total_rank ASC, T.id ASC'''
+COLUMNS = ['total_runtime', 'latency', 'timeliness', 'accuracy', 'last_run', 'benchmark_runtime']
+
+
+def random_result(rng):
+    # Few distinct values, so that ties and disappearing values are common
+    result = {column: rng.choice([None, 1.0, 2.0, 3.0, 4.5]) for column in COLUMNS[:4]}
+    result['last_run'] = '2020-01-%02dT10:00:00' % rng.randint(1, 28)
+    result['benchmark_runtime'] = rng.randint(60, 600)
+    return result
+
+
+class TestRankingIndex(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute('CREATE TABLE teams (id INTEGER PRIMARY KEY, name TEXT, %s)' % ', '.join(COLUMNS))
+
+    def sql_ranking(self):
+        return [tuple(row) for row in self.db.execute(RANKING_QUERY)]
+
+    def sql_maxima(self):
+        return self.db.execute('SELECT MAX(last_run), MAX(benchmark_runtime) FROM teams').fetchone()
+
+    def index_ranking(self, index):
+        rows, last_run, max_runtime = index.ranked()
+        return [(row['id'], row['total_rank']) for row in rows], (last_run, max_runtime)
+
+    def write(self, team_id, result):
+        assignments = ', '.join('%s = ?' % column for column in result)
+        self.db.execute('UPDATE teams SET %s WHERE id = ?' % assignments, list(result.values()) + [team_id])
+
+    def test_empty_table(self):
+        self.assertEqual(RankingIndex([]).ranked(), ([], "", 0))
+
+    def test_bulk_load_matches_sql(self):
+        # Mostly distinct values, every row of the load adds new keys
+        rng = random.Random(7)
+        for team_id in range(1, 501):
+            result = {column: rng.choice([None, rng.random()]) for column in COLUMNS[:4]}
+            self.db.execute('INSERT INTO teams (id, name) VALUES (?, ?)', (team_id, 'team%d' % team_id))
+            self.write(team_id, result)
+        columns = ['id', 'name'] + COLUMNS
+        index = RankingIndex(dict(zip(columns, row)) for row in self.db.execute('SELECT %s FROM teams' % ', '.join(columns)))
+        self.assertEqual(self.index_ranking(index)[0], self.sql_ranking())
+
+    def test_incremental_updates_match_sql(self):
+        self.check_random_updates(teams=30, updates=300)
+
+    def test_single_moves_match_sql(self):
+        # With many teams per distinct value, most writes only move the written team
+        self.check_random_updates(teams=200, updates=300)
+
+    def check_random_updates(self, teams, updates):
+        rng = random.Random(42)
+        for team_id in range(1, teams + 1):
+            self.db.execute('INSERT INTO teams (id, name) VALUES (?, ?)', (team_id, 'team%d' % team_id))
+            self.write(team_id, random_result(rng))
+        columns = ['id', 'name'] + COLUMNS
+        rows = [dict(zip(columns, row)) for row in self.db.execute('SELECT %s FROM teams' % ', '.join(columns))]
+        index = RankingIndex(rows)
+        self.assertEqual(self.index_ranking(index), (self.sql_ranking(), self.sql_maxima()))
+        for _ in range(updates):
+            team_id = rng.randint(1, teams)
+            result = random_result(rng)
+            self.write(team_id, result)
+            index.update(team_id, result)
+            self.assertEqual(self.index_ranking(index), (self.sql_ranking(), self.sql_maxima()))
+
+    def test_insert_new_team(self):
+        index = RankingIndex([dict(id=1, name='a', total_runtime=2.0, latency=1.0, timeliness=0.5, accuracy=0.5)])
+        index.insert(dict(id=2, name='b', total_runtime=1.0, latency=1.0, timeliness=0.5, accuracy=0.5))
+        rows, _, _ = index.ranked()
+        self.assertEqual([(row['name'], row['rank_total_runtime'], row['total_rank']) for row in rows],
+                         [('b', 1, 4), ('a', 2, 5)])
+
+    def test_find_by_image_and_name(self):
+        index = RankingIndex([dict(id=1, name='a', image='a/a'), dict(id=2, name='b', image=None)])
+        index.insert(dict(id=3, name='c', image='c/c'))
+        self.assertEqual([index.find('image', 'a/a'), index.find('name', 'b'), index.find('image', 'c/c')], [1, 2, 3])
+        index.update(1, dict(image='a/new'))
+        self.assertIsNone(index.find('image', 'a/a'))
+        self.assertEqual(index.find('image', 'a/new'), 1)
+
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+from ranking_engine import RankingEngine, parse_weights, create_ranking_engine
+from test_ranking import RANKING_QUERY, COLUMNS, random_result
+import unittest
+import sqlite3
+import random
+import time
+
+
+class TestRankingEngine(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute('CREATE TABLE teams (id INTEGER PRIMARY KEY, name TEXT, %s)' % ', '.join(COLUMNS))
+        rng = random.Random(7)
+        for team_id in range(1, 201):
+            result = random_result(rng)
+            self.db.execute('INSERT INTO teams (id, name, %s) VALUES (?, ?, %s)' % (
+                ', '.join(result), ', '.join('?' for _ in result)), [team_id, 'team%d' % team_id] + list(result.values()))
+        columns = ['id', 'name'] + COLUMNS
+        self.rows = [dict(zip(columns, row)) for row in self.db.execute('SELECT %s FROM teams' % ', '.join(columns))]
+
+    def engine_ranking(self, engine):
+        return [(row['id'], row['total_rank']) for row in engine.rank(self.rows)]
+
+    def test_default_strategy_matches_sql(self):
+        engine = RankingEngine('dense_rank_sum', '')
+        self.assertTrue(engine.is_default())
+        self.assertEqual(self.engine_ranking(engine), [tuple(row) for row in self.db.execute(RANKING_QUERY)])
+
+    def test_weighted_ranks_match_sql(self):
+        query = RANKING_QUERY.replace('R.rank_latency', '2 * R.rank_latency').replace('R.rank_accuracy', '0.5 * R.rank_accuracy')
+        expected = [(team_id, total) for team_id, total in self.db.execute(query)]
+        self.assertEqual(self.engine_ranking(RankingEngine('dense_rank_sum', 'latency=2, accuracy=0.5')), expected)
+
+    def test_normalized_scores(self):
+        rows = [dict(id=1, total_runtime=10.0, latency=1.0, timeliness=1.0, accuracy=1.0),
+                dict(id=2, total_runtime=20.0, latency=1.0, timeliness=1.0, accuracy=1.0),
+                dict(id=3, total_runtime=11.0, latency=3.0, timeliness=1.0, accuracy=None)]
+        ranked = RankingEngine('normalized', '').rank(rows)
+        self.assertEqual([(row['id'], row['total_rank']) for row in ranked], [(1, 0), (2, 1), (3, 2.1)])
+        self.assertEqual(ranked[2]['rank_accuracy'], 2)
+
+    def test_configuration_errors(self):
+        self.assertRaises(ValueError, RankingEngine, 'unknown', '')
+        self.assertRaises(ValueError, parse_weights, 'speed=2')
+        self.assertEqual(parse_weights('latency=2').tolist(), [1.0, 2.0, 1.0, 1.0])
+        self.assertIsNone(create_ranking_engine())
+
+    def test_thousands_of_teams(self):
+        rows = [dict(row, id=copy * 1000 + row['id']) for copy in range(25) for row in self.rows]
+        start = time.time()
+        ranked = RankingEngine('normalized', 'latency=2').rank(rows)
+        self.assertEqual(len(ranked), 5000)
+        self.assertLess(time.time() - start, 1.0)
+
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+from security import TTLCache, IDENTITIES, IDENTITY_CACHE_SIZE, identity, authenticate, registrations
+import database_access_object
+import unittest
+import tempfile
+import os
+
+DIRECTORY = tempfile.TemporaryDirectory()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Loader:
+    def __init__(self):
+        '''Returns the key and counts the calls'''
+        self.calls = 0
+
+    def __call__(self, key):
+        def load():
+            self.calls += 1
+            return key
+        return load
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.load = Loader()
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = TTLCache(4, 60, clock=self.clock)
+        self.assertEqual(cache.get('a', self.load('a')), 'a')
+        self.clock.now += 59
+        self.assertEqual(cache.get('a', self.load('a')), 'a')
+        self.assertEqual(self.load.calls, 1)
+        self.clock.now += 2
+        self.assertEqual(cache.get('a', self.load('a')), 'a')
+        self.assertEqual(self.load.calls, 2)
+        # A shorter TTL given on put is kept, a longer one is capped
+        cache.put('b', 'b', ttl=10)
+        cache.put('c', 'c', ttl=600)
+        self.clock.now += 11
+        self.assertEqual(cache.get('b', self.load('b')), 'b')
+        self.assertEqual(self.load.calls, 3)
+        self.clock.now += 50
+        self.assertEqual(cache.get('c', self.load('c')), 'c')
+        self.assertEqual(self.load.calls, 4)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TTLCache(IDENTITY_CACHE_SIZE, 60, clock=self.clock)
+        for key in range(IDENTITY_CACHE_SIZE):
+            cache.get(key, self.load(key))
+        cache.get(0, self.load(0))
+        cache.get('new', self.load('new'))
+        self.assertEqual(cache.stats()['size'], IDENTITY_CACHE_SIZE)
+        self.assertEqual(self.load.calls, IDENTITY_CACHE_SIZE + 1)
+        # 0 was used again, 1 is the least recently used one
+        cache.get(0, self.load(0))
+        self.assertEqual(self.load.calls, IDENTITY_CACHE_SIZE + 1)
+        cache.get(1, self.load(1))
+        self.assertEqual(self.load.calls, IDENTITY_CACHE_SIZE + 2)
+
+    def test_version_change_drops_all_entries(self):
+        cache = TTLCache(4, 60, clock=self.clock)
+        cache.get('a', self.load('a'), version=1)
+        cache.get('b', self.load('b'), version=1)
+        cache.get('a', self.load('a'), version=1)
+        self.assertEqual(self.load.calls, 2)
+        cache.get('a', self.load('a'), version=2)
+        cache.get('b', self.load('b'), version=2)
+        self.assertEqual(self.load.calls, 4)
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+
+class TestIdentity(unittest.TestCase):
+    def setUp(self):
+        self.table = registrations()
+        self.table.delete(username='alice')
+        self.table.insert({'username': 'alice', 'password': 'secret', 'team': 'a'})
+        IDENTITIES.invalidate('alice')
+
+    def test_registrations_version_bump_reloads_the_identity(self):
+        self.assertEqual(identity({'sub': 'alice'}, 1)['team'], 'a')
+        self.table.delete(username='alice')
+        # Cached until the version changes
+        self.assertEqual(identity({'sub': 'alice'}, 1)['team'], 'a')
+        self.assertIsNone(identity({'sub': 'alice'}, 2))
+
+    def test_login_drops_the_cached_identity(self):
+        self.assertEqual(identity({'identity': 'alice'}, 1)['password'], 'secret')
+        self.table.update({'username': 'alice', 'password': 'changed'}, ['username'])
+        self.assertIsNone(authenticate('alice', 'secret'))
+        self.assertEqual(identity({'identity': 'alice'}, 1)['password'], 'changed')
+        self.assertEqual(authenticate('alice', 'changed')['team'], 'a')
+
+
+def setUpModule():
+    # Without a configured database, the registrations live in a temporary SQLite file
+    if not database_access_object.DATABASE_URL and 'MYSQL_ROOT_PASSWORD' not in os.environ:
+        database_access_object.DATABASE_URL = 'sqlite:///' + os.path.join(DIRECTORY.name, 'teams.db')
+
+
+def tearDownModule():
+    if (database_access_object.DATABASE_URL or '').startswith('sqlite:///' + DIRECTORY.name):
+        database_access_object.DATABASES.pop(database_access_object.DATABASE_URL).close()
+        database_access_object.DATABASE_URL = None
+    DIRECTORY.cleanup()
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+from shared_state import LocalStateStore, SQLiteStateStore, create_state_store
+import unittest
+import tempfile
+import threading
+import os
+
+
+class StateStoreTests:
+    '''Behaviour shared by every backend, run by the subclasses below with their store'''
+
+    def create_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.create_store()
+
+    def test_get_and_set_round_trip(self):
+        self.assertIsNone(self.store.get('team_status'))
+        self.assertEqual(self.store.get('team_status', {}), {})
+        self.store.set('team_status', {'a/a': 'running', 'b/b': ''})
+        self.assertEqual(self.store.get('team_status'), {'a/a': 'running', 'b/b': ''})
+        self.store.set('team_status', {})
+        self.assertEqual(self.store.get('team_status'), {})
+
+    def test_queue_timing(self):
+        # The waiting time of the queue, read together with the versions of the scoreboard
+        self.store.set('delta_seconds', 1234.5)
+        self.store.incr('jobs_version')
+        self.assertEqual(self.store.get_many(['delta_seconds', 'jobs_version', 'status_version']),
+                         {'delta_seconds': 1234.5, 'jobs_version': 1, 'status_version': None})
+        self.store.set('delta_seconds', 600)
+        self.assertEqual(self.store.get('delta_seconds'), 600)
+
+    def test_update_and_incr(self):
+        def merge(team_status):
+            team_status.update({'a/a': 'running'})
+            return team_status
+        self.assertEqual(self.store.update('team_status', merge, {}), {'a/a': 'running'})
+        self.assertEqual(self.store.update('team_status', lambda value: dict(value, **{'b/b': ''})),
+                         {'a/a': 'running', 'b/b': ''})
+        self.assertEqual([self.store.incr('ranking_version') for _ in range(3)], [1, 2, 3])
+
+    def test_concurrent_increments(self):
+        def increment():
+            for _ in range(50):
+                self.store.incr('status_version')
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.store.get('status_version'), 200)
+
+
+class TestLocalStateStore(StateStoreTests, unittest.TestCase):
+    def create_store(self):
+        return create_state_store('memory')
+
+
+class TestSQLiteStateStore(StateStoreTests, unittest.TestCase):
+    def create_store(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'state.db')
+        return SQLiteStateStore(self.path)
+
+    def test_instances_share_one_file(self):
+        # Like two worker processes on the same host
+        other = SQLiteStateStore(self.path)
+        self.store.set('delta_seconds', 900)
+        self.assertEqual(other.get('delta_seconds'), 900)
+        self.assertEqual(self.store.incr('jobs_version'), 1)
+        self.assertEqual(other.incr('jobs_version'), 2)
+        other.update('team_status', lambda value: dict(value, **{'a/a': 'running'}), {})
+        self.assertEqual(self.store.get_many(['jobs_version', 'team_status']),
+                         {'jobs_version': 2, 'team_status': {'a/a': 'running'}})
+
+    def test_concurrent_increments_of_two_instances(self):
+        stores = [self.store, SQLiteStateStore(self.path)]
+
+        def increment(store):
+            for _ in range(50):
+                store.incr('ranking_version')
+        threads = [threading.Thread(target=increment, args=(store,)) for store in stores for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stores[1].get('ranking_version'), 200)
+
+
+class TestCreateStateStore(unittest.TestCase):
+    def test_unknown_backend(self):
+        self.assertIsInstance(create_state_store('memory'), LocalStateStore)
+        with self.assertRaisesRegex(ValueError, 'Unknown SHARED_STATE_BACKEND'):
+            create_state_store('memcached')
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
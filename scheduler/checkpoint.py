@@ -0,0 +1,49 @@
+import logging
+import json
+import os
+
+# Snapshot of the scheduler state, kept on the mounted log volume across restarts
+SCHEDULER_STATE_FILE = os.getenv("SCHEDULER_STATE_FILE", default="scheduler_logs/scheduler_state.json")
+STATE_FORMAT_VERSION = 1
+
+
+class StateFile:
+
+    def __init__(self, path=SCHEDULER_STATE_FILE):
+        '''Local checkpoint of the scheduler state, so that a restarted scheduler
+        continues where it stopped instead of starting with a cold sweep
+        '''
+        self.path = path
+
+    def exists(self):
+        return bool(self.path) and os.path.exists(self.path)
+
+    def load(self):
+        '''Return the saved state, None if there is none or it can not be used'''
+        if not self.path:
+            return None
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (ValueError, OSError) as e:
+            logging.error('Ignoring unreadable scheduler state %s: %s', self.path, e)
+            return None
+        if not isinstance(state, dict) or state.get('version') != STATE_FORMAT_VERSION:
+            logging.warning('Ignoring scheduler state %s of an unknown format', self.path)
+            return None
+        return state
+
+    def save(self, state):
+        '''Write the state atomically (write to a temporary file, then rename)'''
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(state, version=STATE_FORMAT_VERSION), f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error('Failed to save scheduler state %s: %s', self.path, e)
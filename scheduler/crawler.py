@@ -1,28 +1,263 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import collections
 import datetime
+import threading
 import logging
+import json
+import os
 
 
-DOCKER_REGISTRY_V2 = 'https://hub.docker.com/v2/repositories'
+# Base URL of the DockerHub API, e.g. a local fake registry in tests
+DOCKER_REGISTRY_URL = os.getenv("DOCKER_REGISTRY_URL", default="https://hub.docker.com").rstrip('/')
+# namespace: one paged repository listing per namespace, per-tag lookups only as a fallback
+# tag: one tag lookup per image
+CRAWL_MODE = os.getenv("CRAWL_MODE", default="namespace")
+# Pages of a namespace listing fetched before looking up the remaining images by tag
+CRAWL_NAMESPACE_MAX_PAGES = int(os.getenv("CRAWL_NAMESPACE_MAX_PAGES", default=10))
+NAMESPACE_PAGE_SIZE = 100
+# The tag that is benchmarked, pushes to other tags are ignored.
+# Images without this tag are followed by their most recently pushed tag instead
+CRAWL_TAG = os.getenv("CRAWL_TAG", default="latest")
+# Maximum number of DockerHub requests in flight during a sweep
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", default=8))
+# Timeout (connect and read) for a single DockerHub request
+CRAWL_REQUEST_TIMEOUT_SECONDS = float(os.getenv("CRAWL_REQUEST_TIMEOUT_SECONDS", default=10))
+# Validators and last seen versions of the listings and tags, kept on the mounted log volume across restarts
+CRAWLER_CACHE_FILE = os.getenv("CRAWLER_CACHE_FILE", default="scheduler_logs/crawler_cache.json")
+
+# A crawled tag: pushes that do not change the digest do not change the benchmarked image
+ImageVersion = collections.namedtuple('ImageVersion', ['tag', 'digest', 'last_updated'])
+
+
+class ResponseCache:
+
+    def __init__(self, path):
+        '''Persistent dictionary of url -> {etag, last_modified, last_updated}
+        used to send conditional requests to DockerHub
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+            logging.info('Loaded %d cached image entries from %s', len(self.entries), self.path)
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError) as e:
+            logging.error('Ignoring unreadable crawler cache %s: %s', self.path, e)
+
+    def get(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def put(self, url, etag, last_modified, last_updated, **extra):
+        with self.lock:
+            self.entries[url] = dict(extra, etag=etag, last_modified=last_modified, last_updated=last_updated)
+            self.dirty = True
+
+    def save(self):
+        '''Write the cache atomically, so a crash never leaves a truncated file behind'''
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = dict(self.entries)
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error('Failed to save crawler cache %s: %s', self.path, e)
 
 
 class DockerCrawler:
 
-    def get_last_update_timestamp(self, image):
-        docker_hub_link = image.split('/')
-        url = DOCKER_REGISTRY_V2 + '/%s/%s/tags/' % (docker_hub_link[0], docker_hub_link[1])
-        logging.info('Retrieving image data: %s', url)
+    def __init__(self, concurrency=CRAWL_CONCURRENCY, timeout=CRAWL_REQUEST_TIMEOUT_SECONDS, cache_file=CRAWLER_CACHE_FILE,
+                 registry_url=DOCKER_REGISTRY_URL, mode=CRAWL_MODE, max_pages=CRAWL_NAMESPACE_MAX_PAGES, tag=CRAWL_TAG):
+        '''All requests share one keep-alive session whose connection pool
+        is sized to the number of crawler threads
+        '''
+        if mode not in ('namespace', 'tag'):
+            raise ValueError('Unknown crawl mode "%s"!' % mode)
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.repositories_url = registry_url.rstrip('/') + '/v2/repositories'
+        self.mode = mode
+        self.max_pages = max_pages
+        self.tag = tag
+        # DockerHub requests sent, for the request count per sweep
+        self.requests_sent = 0
+        self.requests_lock = threading.Lock()
+        self.cache = ResponseCache(cache_file)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='crawler')
+
+    def get_image_versions(self, images):
+        '''Crawl the given images concurrently and return a dictionary of image -> ImageVersion
+        of the crawled tag. At most `concurrency` requests are in flight, so a sweep takes roughly
+        as long as the slowest response instead of the sum of all of them.
+        Images that could not be crawled are mapped to None.
+        '''
+        images = list(images)
+        requests_before = self.requests_sent
+        if self.mode == 'namespace':
+            versions = self.crawl_namespaces(images)
+        else:
+            versions = dict(zip(images, self.executor.map(self.get_tag_version, images)))
+        self.cache.save()
+        logging.info('Crawled %d images with %d requests', len(images), self.requests_sent - requests_before)
+        return versions
+
+    def crawl_namespaces(self, images):
+        '''Crawl the images with one repository listing per namespace.
+        The tag of an image is only looked up when its repository changed since the last lookup,
+        was missing from the listing or the listing failed.
+        '''
+        namespaces = {}
+        for image in images:
+            namespaces.setdefault(image.split('/')[0], []).append(image)
+        listings = dict(zip(namespaces, self.executor.map(
+            lambda namespace: self.get_namespace_listing(namespace, [image.split('/')[1] for image in namespaces[namespace]]),
+            namespaces)))
+        versions = {}
+        lookups = []
+        for namespace, namespace_images in namespaces.items():
+            listing = listings[namespace] or {}
+            for image in namespace_images:
+                repository_updated = listing.get(image.split('/')[1])
+                cached = self.cache.get(self.tag_url(image))
+                if repository_updated and cached and cached.get('repository_updated') == repository_updated:
+                    versions[image] = self.cached_version(cached)
+                else:
+                    lookups.append((image, repository_updated))
+        if lookups:
+            logging.info('Looking up the tag of %d images', len(lookups))
+            versions.update(zip([image for image, _ in lookups],
+                                self.executor.map(lambda lookup: self.get_tag_version(*lookup), lookups)))
+        return versions
+
+    def get_namespace_listing(self, namespace, repositories):
+        '''Return a dictionary of repository -> last update time of the namespace,
+        following the pages until all wanted `repositories` were seen. None if the listing failed.
+        '''
+        url = self.repositories_url + '/%s/?page_size=%d' % (namespace, NAMESPACE_PAGE_SIZE)
+        wanted = set(repositories)
+        listing = {}
         try:
-            data = requests.get(url)
-            logging.info('Status Code: %d', data.status_code)
-            logging.debug('Image data: %s', data.json())
+            for _ in range(self.max_pages):
+                page, url = self.get_namespace_page(url)
+                listing.update(page)
+                if not url or wanted.issubset(listing):
+                    break
+            return listing
+        except Exception as e:
+            logging.error('Failed to list namespace %s: %s', namespace, e)
+            return None
+
+    def get_namespace_page(self, url):
+        '''Return ({repository: last_updated}, url of the next page) of a page of a namespace listing'''
+        cached = self.cache.get(url)
+        data = self.get(url, cached)
+        if data.status_code == 304 and cached:
+            return cached['last_updated'], cached.get('next')
+        if data.status_code != 200:
+            raise Exception('Invalid status code %d!' % data.status_code)
+        payload = data.json()
+        page = {repository['name']: repository.get('last_updated') for repository in payload['results']}
+        self.cache.put(url, data.headers.get('ETag'), data.headers.get('Last-Modified'), page, next=payload.get('next'))
+        return page, payload.get('next')
+
+    def get(self, url, cached=None):
+        '''GET a DockerHub URL, conditional on the validators of the cached response'''
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        with self.requests_lock:
+            self.requests_sent += 1
+        return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    def tag_url(self, image):
+        namespace, repository = image.split('/')[:2]
+        return self.repositories_url + '/%s/%s/tags/%s/' % (namespace, repository, self.tag)
+
+    def get_tag_version(self, image, repository_updated=None):
+        '''Return the ImageVersion of the crawled tag of the image. The tag is requested
+        conditionally, so an unchanged tag costs a 304 without any JSON parsing.
+        `repository_updated` is the last update time of the repository in its namespace listing
+        '''
+        url = self.tag_url(image)
+        logging.debug('Retrieving image data: %s', url)
+        try:
+            cached = self.cache.get(url)
+            data = self.get(url, cached)
+            logging.debug('Status Code: %d', data.status_code)
+            if data.status_code == 304 and cached:
+                logging.debug('Image not modified: %s', image)
+                self.cache.put(url, cached['etag'], cached['last_modified'], cached['last_updated'],
+                               digest=cached.get('digest'), repository_updated=repository_updated)
+                return self.cached_version(cached)
+            if data.status_code == 404:
+                return self.get_latest_tag_version(image, repository_updated)
             if data.status_code != 200:
-                raise Exception('Invalid status code! Is the image public?')
-            last_updated = data.json()['results'][0]['last_updated']
-            return self.convert_time(last_updated)
-        except:
-            logging.error('Failed to access image!')
+                raise Exception('Invalid status code %d! Is the image public and tagged %s?' % (data.status_code, self.tag))
+            payload = data.json()
+            logging.debug('Image data: %s', payload)
+            # Digest of the manifest (list), older tags only carry the digests of their platform images
+            digest = payload.get('digest') or next((platform.get('digest') for platform in payload.get('images') or []), None)
+            self.cache.put(url, data.headers.get('ETag'), data.headers.get('Last-Modified'), payload['last_updated'],
+                           digest=digest, repository_updated=repository_updated)
+            return ImageVersion(self.tag, digest, self.convert_time(payload['last_updated']))
+        except Exception as e:
+            logging.error('Failed to access image %s: %s', image, e)
             return
 
+    def get_latest_tag_version(self, image, repository_updated=None):
+        '''Return the ImageVersion of the most recently pushed tag of an image without the crawled tag,
+        like the scheduler did before it followed a single tag. None if the image has no tags
+        '''
+        namespace, repository = image.split('/')[:2]
+        url = self.repositories_url + '/%s/%s/tags/?page_size=1&ordering=last_updated' % (namespace, repository)
+        data = self.get(url)
+        if data.status_code != 200:
+            raise Exception('Invalid status code %d! Is the image public?' % data.status_code)
+        results = data.json().get('results')
+        if not results:
+            raise Exception('Image has no tags!')
+        tag = results[0]
+        logging.info('Image %s has no tag %s, following its latest tag %s', image, self.tag, tag['name'])
+        digest = tag.get('digest') or next((platform.get('digest') for platform in tag.get('images') or []), None)
+        # Cached under the URL of the crawled tag without validators, so the tag is looked up again
+        # whenever the repository changes
+        self.cache.put(self.tag_url(image), None, None, tag['last_updated'], digest=digest,
+                       repository_updated=repository_updated, tag=tag['name'])
+        return ImageVersion(tag['name'], digest, self.convert_time(tag['last_updated']))
+
+    def cached_version(self, cached):
+        return ImageVersion(cached.get('tag', self.tag), cached.get('digest'), self.convert_time(cached['last_updated']))
+
     def convert_time(self, s):
-        return datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%fZ').replace(microsecond=0).replace(second=0)
+        for time_format in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+            try:
+                return datetime.datetime.strptime(s, time_format)
+            except ValueError:
+                continue
+        raise ValueError('Unknown time format: %s' % s)
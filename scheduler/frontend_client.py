@@ -0,0 +1,156 @@
+import requests
+from requests.adapters import HTTPAdapter
+import logging
+import random
+import time
+import os
+
+FRONTEND_CONNECT_TIMEOUT_SECONDS = float(os.getenv("FRONTEND_CONNECT_TIMEOUT_SECONDS", default=3))
+FRONTEND_READ_TIMEOUT_SECONDS = float(os.getenv("FRONTEND_READ_TIMEOUT_SECONDS", default=10))
+# Retries of a failed request, after jittered exponential delays starting at FRONTEND_RETRY_BASE_SECONDS
+FRONTEND_RETRIES = int(os.getenv("FRONTEND_RETRIES", default=2))
+FRONTEND_RETRY_BASE_SECONDS = float(os.getenv("FRONTEND_RETRY_BASE_SECONDS", default=0.5))
+# Consecutive failed requests after which calls fail fast, and for how long
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", default=3))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", default=30))
+# Startup waits for the controller's /ready, checking every FRONTEND_READY_POLL_SECONDS
+FRONTEND_READY_POLL_SECONDS = float(os.getenv("FRONTEND_READY_POLL_SECONDS", default=0.5))
+FRONTEND_READY_TIMEOUT_SECONDS = float(os.getenv("FRONTEND_READY_TIMEOUT_SECONDS", default=120))
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS, clock=time.time):
+        '''Fail fast while the frontend is down: after `failure_threshold` consecutive
+        failures the circuit opens, and a single trial call is let through every `reset_seconds`
+        '''
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+
+    def allow(self):
+        if self.state == 'open' and self.clock() - self.opened_at >= self.reset_seconds:
+            self.state = 'half-open'
+            return True
+        return self.state == 'closed'
+
+    def record_success(self):
+        if self.state != 'closed':
+            logging.info('Frontend is reachable again, closing the circuit')
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logging.warning('Frontend unreachable after %d failed requests, failing fast for %d seconds',
+                                self.failures, self.reset_seconds)
+            self.state = 'open'
+            self.opened_at = self.clock()
+
+
+class FrontendClient:
+
+    def __init__(self, base_url, session=None, retries=FRONTEND_RETRIES, breaker=None, sleep=time.sleep):
+        '''HTTP client of the controller: one keep-alive session, explicit timeouts,
+        jittered retries of connection errors, timeouts and 5xx responses, and a circuit breaker
+        '''
+        self.base_url = base_url
+        self.session = session or requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.timeout = (FRONTEND_CONNECT_TIMEOUT_SECONDS, FRONTEND_READ_TIMEOUT_SECONDS)
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self.sleep = sleep
+
+    def request(self, method, path, **kwargs):
+        '''Send a request, raising a RequestException once all attempts failed or the circuit is open'''
+        if not self.breaker.allow():
+            raise CircuitOpenError('Circuit open, not calling %s' % path)
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.sleep(FRONTEND_RETRY_BASE_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1))
+            try:
+                response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                error = requests.exceptions.HTTPError('Status %d from %s' % (response.status_code, path), response=response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            logging.warning('Request %s %s failed (attempt %d/%d): %s', method, path, attempt + 1, self.retries + 1, error)
+        self.breaker.record_failure()
+        raise error
+
+    def wait_until_ready(self, timeout=FRONTEND_READY_TIMEOUT_SECONDS, interval=FRONTEND_READY_POLL_SECONDS, clock=time.time):
+        '''Poll /ready until the controller serves requests, bypassing retries and the circuit breaker.
+        Return the seconds waited, None if it was not ready within `timeout` seconds
+        '''
+        start = clock()
+        while True:
+            try:
+                if self.session.get(self.base_url + '/ready', timeout=self.timeout).status_code == 200:
+                    return clock() - start
+            except requests.exceptions.RequestException as e:
+                logging.debug('Controller not reachable yet: %s', e)
+            if clock() - start >= timeout:
+                return None
+            self.sleep(interval)
+
+    def get_schedule(self, etag=None):
+        return self.request('GET', '/schedule', headers={'If-None-Match': etag} if etag else {})
+
+    def post_schedule(self, payload):
+        '''Send image updates. Return False if they have to be sent again: on connection errors,
+        timeouts, 5xx and 429 responses. Updates rejected with any other 4xx status are dropped,
+        sending them again would be rejected the same way
+        '''
+        try:
+            response = self.request('POST', '/schedule', json=payload)
+        except requests.exceptions.RequestException as e:
+            logging.error('Failed to send image schedule, will retry: %s', e)
+            return False
+        logging.info('Finished sending image schedule. Response: %s', response.status_code)
+        if response.status_code == 429:
+            logging.warning('Controller throttled the image schedule, will retry')
+            return False
+        if response.status_code >= 400:
+            logging.error('Controller rejected image schedule with status %d, dropping the updates of %s',
+                          response.status_code, sorted(payload))
+        return True
+
+
+class Outbox:
+
+    def __init__(self, pending=None):
+        '''Image updates not yet delivered to the controller, image -> timestamp.
+        A newer update of an image replaces the pending one.
+        '''
+        self.pending = dict(pending or {})
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, updates):
+        self.pending.update(updates)
+
+    def flush(self, send):
+        '''Deliver all pending updates with `send(payload)` -> bool. Return True if they were delivered'''
+        if not self.pending:
+            return False
+        payload = dict(self.pending)
+        if not send(payload):
+            return False
+        for image, timestamp in payload.items():
+            if self.pending.get(image) == timestamp:
+                del self.pending[image]
+        return True
@@ -0,0 +1,133 @@
+import heapq
+import random
+import datetime
+import logging
+import time
+
+
+class PollingQueue:
+
+    def __init__(self, min_interval, max_interval, backoff_factor=2.0, jitter=0.5, clock=time.time):
+        '''Priority queue of images keyed by the time their next crawl is due.
+        Every image has its own polling interval: it is reset to `min_interval`
+        when the image changes and grows by `backoff_factor` (up to `max_interval`)
+        every time the image is found unchanged. Failed crawls are retried after
+        a jittered exponential delay that does not touch the regular interval.
+        '''
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.clock = clock
+        self.heap = []  # (due_time, image), may contain stale entries
+        self.due_times = {}  # image -> current due time
+        self.intervals = {}  # image -> current polling interval
+        self.failures = {}  # image -> number of consecutive failed crawls
+
+    def __contains__(self, image):
+        return image in self.due_times
+
+    def __len__(self):
+        return len(self.due_times)
+
+    def add(self, image, due_time=None):
+        '''Schedule a new image, by default for an immediate crawl'''
+        if image in self.due_times:
+            return
+        self.intervals[image] = self.min_interval
+        self.failures[image] = 0
+        self._push(image, self.clock() if due_time is None else due_time)
+
+    def remove(self, image):
+        '''Stop polling the image. Its heap entry is dropped lazily'''
+        self.due_times.pop(image, None)
+        self.intervals.pop(image, None)
+        self.failures.pop(image, None)
+
+    def pop_due(self, now=None):
+        '''Return all images whose crawl is due. They are rescheduled by `reschedule`'''
+        now = self.clock() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due_time, image = heapq.heappop(self.heap)
+            if self.due_times.get(image) == due_time:
+                del self.due_times[image]
+                due.append(image)
+        return due
+
+    def seconds_until_next_due(self, now=None):
+        '''Seconds until the next crawl is due, None if nothing is scheduled'''
+        while self.heap and self.due_times.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        now = self.clock() if now is None else now
+        return max(0, self.heap[0][0] - now)
+
+    def reschedule(self, image, changed=False, failed=False, now=None):
+        '''Compute the next due time of a crawled image from the crawl outcome'''
+        if image not in self.intervals:
+            return
+        now = self.clock() if now is None else now
+        if failed:
+            self.failures[image] += 1
+            retry = min(self.max_interval, self.min_interval * self.backoff_factor ** (self.failures[image] - 1))
+            delay = retry * random.uniform(1 - self.jitter, 1)
+            logging.info('Retrying image %s in %d seconds after %d failed attempts', image, delay, self.failures[image])
+        else:
+            self.failures[image] = 0
+            if changed:
+                self.intervals[image] = self.min_interval
+            else:
+                self.intervals[image] = min(self.max_interval, self.intervals[image] * self.backoff_factor)
+            delay = self.intervals[image]
+        self._push(image, now + delay)
+
+    def state(self):
+        '''Return the polling state as {image: [due_time, interval, failures]}.
+        Images being crawled (popped but not yet rescheduled) are saved as due now.
+        '''
+        now = self.clock()
+        return {image: [self.due_times.get(image, now), interval, self.failures[image]]
+                for image, interval in self.intervals.items()}
+
+    def restore(self, state):
+        '''Restore the polling state saved by `state()`, replacing the current one'''
+        self.heap = []
+        self.due_times = {}
+        self.intervals = {}
+        self.failures = {}
+        for image, (due_time, interval, failures) in state.items():
+            self.intervals[image] = min(max(interval, self.min_interval), self.max_interval)
+            self.failures[image] = failures
+            self._push(image, due_time)
+
+    def _push(self, image, due_time):
+        self.due_times[image] = due_time
+        heapq.heappush(self.heap, (due_time, image))
+
+
+class DetectionDelay:
+
+    def __init__(self):
+        '''Time between an image push on DockerHub and its detection by the scheduler'''
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def observe(self, image, pushed_at, detected_at=None):
+        detected_at = detected_at or datetime.datetime.utcnow()
+        delay = max(0.0, (detected_at - pushed_at).total_seconds())
+        self.count += 1
+        self.total_seconds += delay
+        self.max_seconds = max(self.max_seconds, delay)
+        self.last_seconds = delay
+        logging.info('Detected update of image %s %d seconds after push', image, delay)
+
+    def mean_seconds(self):
+        return self.total_seconds / self.count if self.count else 0.0
+
+    def summary(self):
+        return {'count': self.count, 'mean_seconds': round(self.mean_seconds(), 1),
+                'max_seconds': round(self.max_seconds, 1), 'last_seconds': round(self.last_seconds, 1)}
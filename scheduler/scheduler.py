@@ -1,123 +1,257 @@
 import logging
-from logging.handlers import TimedRotatingFileHandler
 import os
 import json
 import datetime
 from crawler import DockerCrawler
+from polling import PollingQueue, DetectionDelay
+from checkpoint import StateFile
+from frontend_client import FrontendClient, Outbox
+from logging_setup import configure_logging
 import time
 import requests
 
-SCHEDULE_ENDPOINT = '/schedule'
 CRAWL_DOCKERHUB_FREQUENCY_SECONDS = int(os.getenv("CRAWL_DOCKERHUB_FREQUENCY_SECONDS", default=60))
+# Upper bound of the polling interval of images that have not changed for a long time
+CRAWL_MAX_INTERVAL_SECONDS = int(os.getenv("CRAWL_MAX_INTERVAL_SECONDS", default=1800))
+CRAWL_BACKOFF_FACTOR = float(os.getenv("CRAWL_BACKOFF_FACTOR", default=2))
+# How often the team list is re-fetched from the controller to pick up added or removed teams
+SCHEDULE_RELOAD_SECONDS = int(os.getenv("SCHEDULE_RELOAD_SECONDS", default=30))
 LOG_FOLDER = "scheduler_logs"
 LOG_FILE = 'scheduler.log'
-os.makedirs(LOG_FOLDER, exist_ok=True)
-logging.basicConfig(
-                    level=logging.DEBUG,
-                    format='%(asctime)s - %(name)s - %(threadName)s -  %(levelname)s - %(message)s',
-                    handlers=[
-                     TimedRotatingFileHandler("%s/%s" % (LOG_FOLDER, LOG_FILE), when="midnight", interval=1), 
-                     logging.StreamHandler()
-                    ])
+configure_logging(LOG_FOLDER, LOG_FILE)
 
 FRONTEND_ENDPOINT = os.getenv("FRONTEND_SERVER")
 if not FRONTEND_ENDPOINT:
     raise ValueError("Please specify FRONTEND_SERVER environment variable!")
 else:
-    FRONTEND_ENDPOINT = "http://" + FRONTEND_ENDPOINT + SCHEDULE_ENDPOINT
+    FRONTEND_ENDPOINT = "http://" + FRONTEND_ENDPOINT
 
 
 class Scheduler:
 
-    def __init__(self):
-        '''Initialize and retrieve all images from frontend server (controller)
-        After that, the cached images are used for scheduling. 
-        In case a new image is added, the scheduler needs to be restarted by the controller!
+    def __init__(self, state_file=None, client=None):
+        '''Initialize from the state saved by the previous run, if any, and reconcile it
+        with the images of the frontend server (controller).
+        After that, the cached images are used for scheduling.
+        Added or removed teams are picked up by `reload_schedule`, no restart is needed.
         '''
         json.JSONEncoder.default = lambda self,obj: (obj.isoformat() if isinstance(obj, datetime.datetime) else None)
         self.schedule = {}
-        try:
-            self.schedule, _ = self.reguest_all_images()
-        except requests.exceptions.ConnectionError as e:
-            logging.error("Make sure that server you are trying to connect is up. %s" % e)
-            logging.error("Please start the scheduler again when the frontend server is up!")
-            logging.error("You can do this by executing 'docker restart scheduler'.")
-            exit(1)
+        self.schedule_etag = None
+        self.schedule_reloaded_at = time.time()
         self.last_updated_images = {} #snapshot
+        # image -> [tag, digest] of the last detected version, an update is only sent when it changes
+        self.image_digests = {}
+        # Images whose last update time was saved before digests were tracked, truncated to the minute
+        self.legacy_timestamps = set()
+        # Pushes that did not change the digest of the crawled tag, runs that were not scheduled
+        self.redundant_runs_skipped = 0
         self.crawler = DockerCrawler()
+        self.polling = PollingQueue(CRAWL_DOCKERHUB_FREQUENCY_SECONDS, CRAWL_MAX_INTERVAL_SECONDS, CRAWL_BACKOFF_FACTOR)
+        self.detection_delay = DetectionDelay()
+        self.client = client or FrontendClient(FRONTEND_ENDPOINT)
+        # Image updates waiting to be delivered to the controller
+        self.outbox = Outbox()
+        self.state_file = state_file or StateFile()
+        self.dirty = False
+        self.restore(self.state_file.load())
+        try:
+            # Answered with a 304 when the restored schedule is still current
+            schedule, _ = self.reguest_all_images()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Keep going with the restored schedule, `reload_schedule` retries right away
+            logging.error("Failed to request the schedule from the frontend server: %s", e)
+            schedule = None
+            self.schedule_reloaded_at = 0
+        if schedule is not None:
+            self.merge_schedule(schedule)
+
+    def restore(self, state):
+        '''Continue from a state saved by `checkpoint`'''
+        if not state:
+            return
+        self.schedule = state['schedule']
+        self.schedule_etag = state.get('schedule_etag')
+        self.last_updated_images = {image: datetime.datetime.fromisoformat(timestamp)
+                                    for image, timestamp in state['last_updated_images'].items()}
+        self.image_digests = state.get('image_digests', {})
+        if 'image_digests' in state:
+            self.legacy_timestamps = set(state.get('legacy_timestamps', []))
+        else:
+            self.legacy_timestamps = set(self.last_updated_images)
+        self.polling.restore({image: polling for image, polling in state['polling'].items() if image in self.schedule})
+        self.outbox.add({image: datetime.datetime.fromisoformat(timestamp)
+                         for image, timestamp in state.get('outbox', {}).items()})
+        for image in self.schedule:
+            self.polling.add(image)
+        logging.info("Restored the state of %d images", len(self.schedule))
+
+    def checkpoint(self):
+        '''Save the state if it changed since the last checkpoint'''
+        if not self.dirty:
+            return
+        self.state_file.save({
+            'schedule': self.schedule,
+            'schedule_etag': self.schedule_etag,
+            'last_updated_images': {image: timestamp.isoformat() for image, timestamp in self.last_updated_images.items()},
+            'image_digests': self.image_digests,
+            'legacy_timestamps': sorted(self.legacy_timestamps),
+            'polling': self.polling.state(),
+            'outbox': {image: timestamp.isoformat() for image, timestamp in self.outbox.pending.items()},
+        })
+        self.dirty = False
 
     def reguest_all_images(self):
-        '''Request all the images from the frontend server
+        '''Request all the images from the frontend server.
+        The request is conditional on the last seen schedule version,
+        an unchanged schedule is returned as (None, 304)
         '''
-        response = requests.get(FRONTEND_ENDPOINT)
-        logging.info(response.status_code)
+        response = self.client.get_schedule(self.schedule_etag)
+        logging.debug("Schedule request status: %d", response.status_code)
+        if response.status_code == 304:
+            return None, response.status_code
         schedule = response.json()
-        logging.info("Requested image list is: %s " % schedule)
+        self.schedule_etag = response.headers.get('ETag')
+        logging.info("Requested image list of %d images", len(schedule))
+        logging.debug("Requested image list is: %s", schedule)
         return schedule, response.status_code
 
-    def run(self):
+    def reload_schedule(self):
+        '''Merge team membership changes from the controller into the running schedule.
+        New images are crawled right away, removed images are forgotten.
+        The state of the remaining images is kept.
+        '''
+        if time.time() - self.schedule_reloaded_at < SCHEDULE_RELOAD_SECONDS:
+            return
+        self.schedule_reloaded_at = time.time()
+        try:
+            schedule, status_code = self.reguest_all_images()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error("Failed to reload schedule, keeping the current one: %s", e)
+            return
+        if status_code != 200 or schedule is None:
+            return
+        self.merge_schedule(schedule)
+
+    def merge_schedule(self, schedule):
+        for image in set(self.schedule) - set(schedule):
+            logging.info("Image %s was removed from the schedule", image)
+            del self.schedule[image]
+            self.last_updated_images.pop(image, None)
+            self.image_digests.pop(image, None)
+            self.legacy_timestamps.discard(image)
+            self.polling.remove(image)
+        for image in set(schedule) - set(self.schedule):
+            logging.info("Image %s was added to the schedule", image)
+            self.schedule[image] = schedule[image]
+            self.polling.add(image)
+        self.dirty = True
+
+    def send_updates(self, updated_images=None):
+        '''Queue the updated images and deliver everything pending to the controller.
+        Undelivered updates stay in the outbox (and the checkpoint) and are retried on the next call.
+        '''
+        if updated_images:
+            self.outbox.add(updated_images)
+            self.dirty = True
+        if self.outbox.flush(self.client.post_schedule):
+            self.dirty = True
+        elif self.outbox:
+            logging.info("%d image updates waiting for the frontend server", len(self.outbox))
+
+    def run(self, images=None):
+        '''Crawl the given images (all scheduled images by default) and update their status.
+        An image is updated when the digest of its crawled tag changed,
+        or its last update time when the registry reports no digest.
+        '''
         self.updated_status = False
-        for image, status in self.schedule.items():
+        images = list(self.schedule) if images is None else [image for image in images if image in self.schedule]
+        versions = self.crawler.get_image_versions(images)
+        self.dirty = self.dirty or bool(images)
+        for image in images:
+                status = self.schedule[image]
                 old_timestamp = self.last_updated_images.get(image)
-                new_timestamp = self.crawler.get_last_update_timestamp(image)
-                if old_timestamp == new_timestamp:
+                old_digest = self.image_digests.get(image)
+                version = versions.get(image)
+                if version is None:
+                    # Crawl failed or timed out, keep the previous state and retry later
+                    logging.warning('Could not retrieve version of image: %s', image)
+                    self.polling.reschedule(image, failed=True)
+                    continue
+                new_timestamp = version.last_updated
+                new_digest = [version.tag, version.digest] if version.digest else None
+                if new_digest and old_digest:
+                    changed = new_digest != old_digest
+                elif image in self.legacy_timestamps:
+                    # Saved before digests were tracked, with timestamps truncated to the minute
+                    changed = old_timestamp != new_timestamp.replace(second=0, microsecond=0)
+                else:
+                    changed = old_timestamp != new_timestamp
+                if new_digest:
+                    self.image_digests[image] = new_digest
+                self.legacy_timestamps.discard(image)
+                if not changed:
                     # Image not updated
-                    logging.debug('Image has not been updated: %s', image)
+                    if old_digest and old_timestamp != new_timestamp:
+                        logging.info('Image %s was pushed at %s without changing %s:%s, not running it again',
+                                     image, new_timestamp, version.tag, version.digest)
+                        self.redundant_runs_skipped += 1
+                    else:
+                        logging.debug('Image has not been updated: %s', image)
+                    self.last_updated_images[image] = new_timestamp
                     self.schedule[image] = 'old'
-                elif old_timestamp is None and status == 'old':
-                    # old timestamp missing
-                    # do nothing, only save timestamp as current one
+                    self.polling.reschedule(image)
+                elif old_timestamp is None and old_digest is None and status == 'old':
+                    # old version missing
+                    # do nothing, only save version as current one
                     logging.info("all images are same")
                     self.last_updated_images[image] = new_timestamp
                     self.updated_status = True
+                    self.polling.reschedule(image)
                 else:
                     # Image updated
-                    logging.info('New tag for image %s detected at %s', image, new_timestamp)
+                    logging.info('New version %s of image %s detected, pushed at %s', version.digest, image, new_timestamp)
                     self.last_updated_images[image] = new_timestamp
                     self.updated_status = True
                     self.schedule[image] = 'updated'
-        logging.info("All team images checked")
-
-
-def post_schedule(payload):
-    headers = {'Content-type': 'application/json'}
-    try:
-        response = requests.post(FRONTEND_ENDPOINT, json = payload, headers=headers)
-        logging.info('Finished sending image schedule. Response: %s' % response.status_code)
-        if (response.status_code == 201):
-            return {'status': 'success', 'message': 'updated'}
-        if (response.status_code == 404):
-            return {'message': 'Something went wrong!'}
-    except requests.exceptions.ConnectionError as e:
-        logging.error("Please specify Frontend server address! %s", e)
-        exit(1)
-    return response.status_code
+                    self.polling.reschedule(image, changed=True)
+                    if old_timestamp is not None:
+                        self.detection_delay.observe(image, new_timestamp)
+        logging.info("%d team images checked", len(images))
 
 
 if __name__ == '__main__':
-    logging.info("Waiting for DB server to start")
-    logging.info("Waiting for the backend server to start")
-    backoff = int(os.getenv("SCHEDULER_STARTUP_BACKOFF", default=30))
-    frontend_backoff = int(os.getenv("FRONTEND_STARTUP_BACKOFF", default=0))
-    if backoff <= frontend_backoff:
-        logging.debug("Sheduler should start after the frontend server. Adding small backoff")
-        backoff = frontend_backoff + 15
-    time.sleep(backoff)
-
-    scheduler = Scheduler()
+    start = time.time()
+    client = FrontendClient(FRONTEND_ENDPOINT)
+    waited = client.wait_until_ready()
+    if waited is None:
+        logging.warning("Frontend server not ready, starting anyway")
+    else:
+        logging.info("Frontend server ready after %.1f seconds", waited)
+
+    scheduler = Scheduler(StateFile(), client)
+    logging.info("Scheduling %d images %.1f seconds after start", len(scheduler.schedule), time.time() - start)
     while(True):
-        scheduler.run()
+        scheduler.reload_schedule()
+        due_images = scheduler.polling.pop_due()
+        if due_images:
+            scheduler.run(due_images)
         updated_images = {}
         if scheduler.updated_status:
-            for image, status in scheduler.schedule.items():
-                    if str(status) == 'updated':
+            for image in due_images:
+                    if str(scheduler.schedule.get(image)) == 'updated':
                         updated_images[image] = scheduler.last_updated_images[image]
 
         if updated_images:
             logging.info("Scheduler sending updated images: %s", updated_images)
-            post_schedule(updated_images)
             scheduler.updated_status = False
-        else:
+            logging.info("Detection delay: %s", scheduler.detection_delay.summary())
+            logging.info("Redundant runs skipped: %d", scheduler.redundant_runs_skipped)
+        elif due_images:
             logging.info("Images weren't updated yet. Idling...")
+        scheduler.send_updates(updated_images)
+        scheduler.checkpoint()
 
-        time.sleep(CRAWL_DOCKERHUB_FREQUENCY_SECONDS)
+        # Sleep until the next image is due, but never longer than the base crawl frequency
+        next_due = scheduler.polling.seconds_until_next_due()
+        time.sleep(CRAWL_DOCKERHUB_FREQUENCY_SECONDS if next_due is None else min(max(next_due, 1), CRAWL_DOCKERHUB_FREQUENCY_SECONDS))
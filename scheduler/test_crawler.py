@@ -0,0 +1,171 @@
+from crawler import DockerCrawler, ImageVersion
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import threading
+import datetime
+import unittest
+import json
+
+
+def digest(repository):
+    return 'sha256:' + repository
+
+
+class FakeRegistry(ThreadingHTTPServer):
+    '''DockerHub API stand-in serving the paged namespace listings of namespace -> {repository: last_updated}.
+    The latest tag of every repository has the digest sha256:<repository> and was pushed at 2020-05-01 10:00
+    '''
+    daemon_threads = True
+
+    def __init__(self, namespaces, page_size=None):
+        super().__init__(('127.0.0.1', 0), FakeRegistryHandler)
+        self.namespaces = namespaces
+        self.page_size = page_size
+        self.tags = {}  # (repository, tag) -> (last_updated, digest) of other tags and pushes
+        self.untagged = set()  # repositories without a latest tag
+        self.paths = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        with self.server.lock:
+            self.server.paths.append(url.path)
+        parts = [part for part in url.path.split('/') if part]  # v2, repositories, namespace[, repository, tags, tag]
+        repositories = self.server.namespaces.get(parts[2])
+        if repositories is None:
+            return self.reply(404, {'message': 'Not found'})
+        if len(parts) == 3:
+            query = parse_qs(url.query)
+            page_size = self.server.page_size or int(query['page_size'][0])
+            page = int(query.get('page', ['1'])[0])
+            names = sorted(repositories)[(page - 1) * page_size:page * page_size]
+            more = page * page_size < len(repositories)
+            return self.reply(200, {
+                'count': len(repositories),
+                'next': '%s%s?page_size=%d&page=%d' % (self.server.url, url.path, page_size, page + 1) if more else None,
+                'results': [{'name': name, 'namespace': parts[2], 'last_updated': repositories[name]} for name in names],
+            })
+        if len(parts) == 5 and parts[3] in repositories:
+            return self.reply(200, {'results': self.tag_listing(parts[3])[:int(parse_qs(url.query)['page_size'][0])]})
+        if (parts[3] not in repositories or parts[5] != 'latest' and (parts[3], parts[5]) not in self.server.tags
+                or parts[5] == 'latest' and parts[3] in self.server.untagged):
+            return self.reply(404, {'message': 'Not found'})
+        last_updated, tag_digest = self.server.tags.get((parts[3], parts[5]), ('2020-05-01T10:00:00.000000Z', digest(parts[3])))
+        return self.reply(200, {'name': parts[5], 'last_updated': last_updated, 'digest': tag_digest})
+
+    def tag_listing(self, repository):
+        '''The tags of the repository, most recently pushed first'''
+        tags = {tag: value for (name, tag), value in self.server.tags.items() if name == repository}
+        if repository not in self.server.untagged:
+            tags.setdefault('latest', ('2020-05-01T10:00:00.000000Z', digest(repository)))
+        return [{'name': tag, 'last_updated': last_updated, 'digest': tag_digest}
+                for tag, (last_updated, tag_digest) in sorted(tags.items(), key=lambda item: item[1][0], reverse=True)]
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDockerCrawler(unittest.TestCase):
+    def start_registry(self, namespaces, page_size=None):
+        registry = FakeRegistry(namespaces, page_size)
+        threading.Thread(target=registry.serve_forever, daemon=True).start()
+        self.addCleanup(registry.server_close)
+        self.addCleanup(registry.shutdown)
+        return registry
+
+    def crawler(self, registry, mode='namespace'):
+        return DockerCrawler(concurrency=4, timeout=5, cache_file=None, registry_url=registry.url, mode=mode)
+
+    def test_one_request_per_namespace(self):
+        namespaces = {'team%d' % team: {'image%d' % image: '2020-05-0%dT12:34:56.789Z' % (image + 1) for image in range(5)}
+                      for team in range(4)}
+        registry = self.start_registry(namespaces)
+        images = ['%s/%s' % (namespace, repository) for namespace in namespaces for repository in namespaces[namespace]]
+        crawler = self.crawler(registry)
+        versions = crawler.get_image_versions(images)
+        self.assertEqual(versions['team1/image2'], ImageVersion('latest', 'sha256:image2', datetime.datetime(2020, 5, 1, 10, 0)))
+        self.assertEqual(len(versions), 20)
+        # The tags are only looked up while the repositories are new or changed
+        self.assertEqual(len(registry.paths), 4 + 20)
+        self.assertEqual(crawler.get_image_versions(images), versions)
+        self.assertEqual(len(registry.paths), 4 + 20 + 4)
+
+    def test_pages_are_followed_until_all_images_are_found(self):
+        registry = self.start_registry({'team': {'image%d' % image: '2020-05-01T10:00:00.0Z' for image in range(10)}},
+                                       page_size=3)
+        crawler = self.crawler(registry)
+        crawler.get_image_versions(['team/image0'])
+        self.assertEqual(len(registry.paths), 1 + 1)
+        versions = crawler.get_image_versions(['team/image0', 'team/image7'])
+        self.assertEqual(len(registry.paths), 2 + 3 + 1)
+        self.assertEqual(versions['team/image7'].digest, 'sha256:image7')
+
+    def test_push_to_another_tag_keeps_the_digest(self):
+        namespaces = {'team': {'image': '2020-05-01T10:00:00.0Z'}}
+        registry = self.start_registry(namespaces)
+        crawler = self.crawler(registry)
+        first = crawler.get_image_versions(['team/image'])['team/image']
+        namespaces['team']['image'] = '2020-05-01T10:00:30.0Z'
+        registry.tags[('image', 'dev')] = ('2020-05-01T10:00:30.0Z', 'sha256:dev')
+        self.assertEqual(crawler.get_image_versions(['team/image'])['team/image'], first)
+        # Two pushes within the same minute
+        registry.tags[('image', 'latest')] = ('2020-05-01T10:00:45.5Z', 'sha256:new')
+        namespaces['team']['image'] = '2020-05-01T10:00:45.5Z'
+        self.assertEqual(crawler.get_image_versions(['team/image'])['team/image'],
+                         ImageVersion('latest', 'sha256:new', datetime.datetime(2020, 5, 1, 10, 0, 45, 500000)))
+
+    def test_fallback_to_tag_lookup(self):
+        registry = self.start_registry({'team': {'image': None}, 'other': {}})
+        versions = self.crawler(registry).get_image_versions(['team/image', 'other/missing', 'unknown/image'])
+        # No last update time in the listing
+        self.assertEqual(versions['team/image'].digest, 'sha256:image')
+        self.assertIn('/v2/repositories/team/image/tags/latest/', registry.paths)
+        # Not in the listing, or no listing at all
+        self.assertIsNone(versions['other/missing'])
+        self.assertIsNone(versions['unknown/image'])
+        # Listings, tags and the tag listings of the images without the tag
+        self.assertEqual(len(registry.paths), 3 + 3 + 2)
+
+    def test_images_without_the_tag_follow_their_latest_push(self):
+        namespaces = {'team': {'image': '2020-05-01T10:00:30.0Z'}}
+        registry = self.start_registry(namespaces)
+        registry.untagged.add('image')
+        registry.tags[('image', 'v1')] = ('2020-05-01T09:00:00.0Z', 'sha256:v1')
+        registry.tags[('image', 'v2')] = ('2020-05-01T10:00:30.0Z', 'sha256:v2')
+        crawler = self.crawler(registry)
+        expected = ImageVersion('v2', 'sha256:v2', datetime.datetime(2020, 5, 1, 10, 0, 30))
+        self.assertEqual(crawler.get_image_versions(['team/image'])['team/image'], expected)
+        self.assertEqual(len(registry.paths), 3)
+        # Unchanged repository, served from the cache
+        self.assertEqual(crawler.get_image_versions(['team/image'])['team/image'], expected)
+        self.assertEqual(len(registry.paths), 4)
+        self.assertEqual(self.crawler(registry, mode='tag').get_image_versions(['team/image'])['team/image'], expected)
+
+    def test_tag_mode(self):
+        registry = self.start_registry({'team': {'a': None, 'b': None}})
+        versions = self.crawler(registry, mode='tag').get_image_versions(['team/a', 'team/b'])
+        self.assertEqual([versions['team/a'].digest, versions['team/b'].digest], ['sha256:a', 'sha256:b'])
+        self.assertEqual(sorted(registry.paths), ['/v2/repositories/team/a/tags/latest/', '/v2/repositories/team/b/tags/latest/'])
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+from frontend_client import FrontendClient, CircuitBreaker, CircuitOpenError, Outbox
+import requests
+import unittest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeSession:
+    def __init__(self, outcomes):
+        '''Answers requests with the given status codes, or raises the given exceptions'''
+        self.outcomes = list(outcomes)
+        self.requests = []
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+
+class TestFrontendClient(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sleeps = []
+
+    def client(self, outcomes, retries=2):
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30, clock=self.clock)
+        return FrontendClient('http://frontend', session=FakeSession(outcomes), retries=retries,
+                              breaker=breaker, sleep=self.sleeps.append)
+
+    def test_retries_transient_errors_with_timeouts(self):
+        client = self.client([requests.exceptions.ConnectionError(), 503, 304])
+        self.assertEqual(client.get_schedule('"v1"').status_code, 304)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertLess(self.sleeps[0], self.sleeps[1] + 0.5)
+        method, url, kwargs = client.session.requests[-1]
+        self.assertEqual((method, url, kwargs['headers']), ('GET', 'http://frontend/schedule', {'If-None-Match': '"v1"'}))
+        self.assertEqual(len(kwargs['timeout']), 2)
+
+    def test_circuit_opens_and_recovers(self):
+        client = self.client([requests.exceptions.Timeout()] * 2 + [200], retries=0)
+        for _ in range(2):
+            self.assertRaises(requests.exceptions.Timeout, client.get_schedule)
+        self.assertRaises(CircuitOpenError, client.get_schedule)
+        self.assertEqual(len(client.session.requests), 2)
+        self.clock.now = 31
+        self.assertEqual(client.get_schedule().status_code, 200)
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_wait_until_ready(self):
+        def sleep(seconds):
+            self.clock.now += seconds
+        client = FrontendClient('http://frontend', session=FakeSession([requests.exceptions.ConnectionError(), 503, 200]),
+                                sleep=sleep)
+        self.assertEqual(client.wait_until_ready(timeout=10, interval=0.5, clock=self.clock), 1.0)
+        self.assertEqual(client.session.requests[-1][1], 'http://frontend/ready')
+        client = FrontendClient('http://frontend', session=FakeSession([503] * 5), sleep=sleep)
+        self.assertIsNone(client.wait_until_ready(timeout=2, interval=0.5, clock=self.clock))
+
+    def test_outbox_keeps_updates_until_delivered(self):
+        client = self.client([requests.exceptions.ConnectionError(), 200], retries=0)
+        outbox = Outbox()
+        outbox.add({'team/a': 1})
+        self.assertFalse(outbox.flush(client.post_schedule))
+        outbox.add({'team/a': 2, 'team/b': 1})
+        self.assertTrue(outbox.flush(client.post_schedule))
+        self.assertEqual(client.session.requests[-1][2]['json'], {'team/a': 2, 'team/b': 1})
+        self.assertEqual(len(outbox), 0)
+        self.assertFalse(outbox.flush(client.post_schedule))
+
+    def test_only_transient_rejections_are_retried(self):
+        client = self.client([429, 503, 403, 400], retries=0)
+        outbox = Outbox()
+        outbox.add({'team/a': 1})
+        # Throttled, then a server error exhausting the retries
+        self.assertFalse(outbox.flush(client.post_schedule))
+        self.assertFalse(outbox.flush(client.post_schedule))
+        self.assertEqual(len(outbox), 1)
+        # Permanent rejections are dropped instead of blocking the updates queued after them
+        self.assertTrue(outbox.flush(client.post_schedule))
+        self.assertEqual(len(outbox), 0)
+        outbox.add({'team/b': 1})
+        self.assertTrue(outbox.flush(client.post_schedule))
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(len(client.session.requests), 4)
+
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
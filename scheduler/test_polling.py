@@ -0,0 +1,76 @@
+from polling import PollingQueue
+import unittest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPollingQueue(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.queue = PollingQueue(60, 480, backoff_factor=2, clock=self.clock)
+
+    def test_new_images_are_due_immediately(self):
+        self.queue.add('team/a')
+        self.queue.add('team/b')
+        self.assertEqual(sorted(self.queue.pop_due()), ['team/a', 'team/b'])
+        self.assertEqual(self.queue.pop_due(), [])
+
+    def test_unchanged_image_backs_off_up_to_cap(self):
+        self.queue.add('team/a')
+        delays = []
+        for _ in range(5):
+            self.assertEqual(self.queue.pop_due(), ['team/a'])
+            self.queue.reschedule('team/a')
+            delays.append(self.queue.seconds_until_next_due())
+            self.clock.now += delays[-1]
+        self.assertEqual(delays, [120, 240, 480, 480, 480])
+
+    def test_changed_image_resets_interval(self):
+        self.queue.add('team/a')
+        self.queue.pop_due()
+        self.queue.reschedule('team/a')
+        self.clock.now += 120
+        self.queue.pop_due()
+        self.queue.reschedule('team/a', changed=True)
+        self.assertEqual(self.queue.seconds_until_next_due(), 60)
+
+    def test_failed_crawl_is_retried_with_jitter(self):
+        self.queue.add('team/a')
+        self.queue.pop_due()
+        self.queue.reschedule('team/a', failed=True)
+        delay = self.queue.seconds_until_next_due()
+        self.assertTrue(30 <= delay <= 60)
+
+    def test_removed_image_is_not_returned(self):
+        self.queue.add('team/a')
+        self.queue.remove('team/a')
+        self.assertEqual(self.queue.pop_due(), [])
+        self.assertIsNone(self.queue.seconds_until_next_due())
+
+    def test_state_round_trip(self):
+        self.queue.add('team/a')
+        self.queue.add('team/b')
+        self.queue.pop_due()
+        self.queue.reschedule('team/a')
+        self.queue.reschedule('team/b', failed=True)
+        self.queue.add('team/c', due_time=30)
+        restored = PollingQueue(60, 480, backoff_factor=2, clock=self.clock)
+        restored.restore(self.queue.state())
+        self.assertEqual(restored.state(), self.queue.state())
+        self.clock.now = 120
+        self.assertEqual(sorted(restored.pop_due()), sorted(self.queue.pop_due()))
+        restored.reschedule('team/a')
+        self.assertEqual(restored.intervals['team/a'], 240)
+
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import os
+os.environ.setdefault('FRONTEND_SERVER', 'frontend:8080')
+from scheduler import Scheduler
+from checkpoint import StateFile
+from crawler import ImageVersion
+import unittest
+import datetime
+import tempfile
+
+PUSHED_AT = datetime.datetime(2020, 5, 1, 10, 0, 30, 250000)
+
+
+class FakeResponse:
+    def __init__(self, status_code, schedule=None, etag=None):
+        self.status_code = status_code
+        self.schedule = schedule
+        self.headers = {'ETag': etag} if etag else {}
+
+    def json(self):
+        return self.schedule
+
+
+class FakeClient:
+    def __init__(self, response):
+        '''Answers every schedule request with the given response'''
+        self.response = response
+        self.etags = []
+
+    def get_schedule(self, etag=None):
+        self.etags.append(etag)
+        return self.response
+
+
+class FakeCrawler:
+    def __init__(self, version):
+        '''Reports the given version for every image'''
+        self.version = version
+
+    def get_image_versions(self, images):
+        return {image: self.version for image in images}
+
+
+class TestSchedulerCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_file = StateFile(os.path.join(self.directory.name, 'state', 'scheduler_state.json'))
+        schedule = {'team/a': 'old', 'team/b': 'updated'}
+        self.scheduler = Scheduler(self.state_file, FakeClient(FakeResponse(200, schedule, '"v1"')))
+        self.scheduler.last_updated_images = {'team/a': PUSHED_AT, 'team/b': PUSHED_AT + datetime.timedelta(minutes=1)}
+        self.scheduler.image_digests = {'team/a': ['latest', 'sha256:a']}
+        self.scheduler.polling.pop_due()
+        self.scheduler.polling.reschedule('team/a')
+        self.scheduler.polling.reschedule('team/b', failed=True)
+        self.scheduler.outbox.add({'team/b': PUSHED_AT})
+        self.scheduler.checkpoint()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        client = FakeClient(FakeResponse(304))
+        restored = Scheduler(self.state_file, client)
+        # The restored schedule is confirmed with a conditional request
+        self.assertEqual(client.etags, ['"v1"'])
+        self.assertEqual(restored.schedule, self.scheduler.schedule)
+        self.assertEqual(restored.last_updated_images, self.scheduler.last_updated_images)
+        self.assertEqual(restored.image_digests, self.scheduler.image_digests)
+        self.assertEqual(restored.outbox.pending, {'team/b': PUSHED_AT})
+        self.assertEqual(restored.polling.state(), self.scheduler.polling.state())
+        self.assertEqual(restored.polling.failures['team/b'], 1)
+
+    def test_images_removed_from_the_schedule_are_dropped(self):
+        restored = Scheduler(self.state_file, FakeClient(FakeResponse(200, {'team/a': 'old', 'team/c': 'old'}, '"v2"')))
+        self.assertEqual(sorted(restored.schedule), ['team/a', 'team/c'])
+        self.assertEqual(sorted(restored.polling.state()), ['team/a', 'team/c'])
+        self.assertNotIn('team/b', restored.last_updated_images)
+        self.assertEqual(restored.schedule_etag, '"v2"')
+        # Polling state saved for an image that is not part of the saved schedule
+        state = self.state_file.load()
+        state['polling']['team/x'] = [0, 60, 0]
+        self.state_file.save(state)
+        restored = Scheduler(self.state_file, FakeClient(FakeResponse(304)))
+        self.assertNotIn('team/x', restored.polling)
+
+    def test_unchanged_state_is_not_saved_again(self):
+        os.remove(self.state_file.path)
+        self.scheduler.checkpoint()
+        self.assertFalse(self.state_file.exists())
+
+
+class TestSchedulerSweeps(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_file = StateFile(os.path.join(self.directory.name, 'state', 'scheduler_state.json'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def sweep(self, scheduler, version, count=3):
+        '''Crawl the image `count` times, return the number of sweeps that found it updated'''
+        scheduler.crawler = FakeCrawler(version)
+        updates = 0
+        for _ in range(count):
+            scheduler.run()
+            updates += scheduler.schedule['team/a'] == 'updated'
+        return updates
+
+    def test_image_without_digest_is_updated_once_per_push(self):
+        scheduler = Scheduler(self.state_file, FakeClient(FakeResponse(200, {'team/a': 'old'}, '"v1"')))
+        self.assertEqual(self.sweep(scheduler, ImageVersion('latest', None, PUSHED_AT)), 0)
+        self.assertEqual(self.sweep(scheduler, ImageVersion('latest', None, PUSHED_AT + datetime.timedelta(seconds=20))), 1)
+
+    def test_timestamps_saved_before_digests_were_tracked(self):
+        self.state_file.save({'schedule': {'team/a': 'old'}, 'polling': {},
+                              'last_updated_images': {'team/a': PUSHED_AT.replace(second=0, microsecond=0).isoformat()}})
+        scheduler = Scheduler(self.state_file, FakeClient(FakeResponse(304)))
+        self.assertEqual(scheduler.legacy_timestamps, {'team/a'})
+        # The saved time was truncated to the minute, the same push is not run again
+        self.assertEqual(self.sweep(scheduler, ImageVersion('latest', None, PUSHED_AT)), 0)
+        self.assertFalse(scheduler.legacy_timestamps)
+        self.assertEqual(self.sweep(scheduler, ImageVersion('latest', None, PUSHED_AT + datetime.timedelta(seconds=20))), 1)
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__":
+    main()